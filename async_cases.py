@@ -0,0 +1,114 @@
+# the asynchronous=True tests, imported by tests.py on python 3 only: async def is a syntax
+# error on python 2, and neither nose nor pytest collects this module by itself
+import asyncio
+
+from nose.tools import eq_, assert_raises
+
+from state_machine import acts_as_state_machine, before, State, Event, after, InvalidStateTransition
+
+
+def run_coroutine(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+
+
+def test_asynchronous_state_machine():
+    @acts_as_state_machine(asynchronous=True, concurrent_after_callbacks=True)
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+        @before('run')
+        async def check_sneakers(self):
+            await asyncio.sleep(0)
+            return self.has_sneakers
+
+        @after('run')
+        async def notify(self):
+            things_done.append('notify started')
+            await asyncio.sleep(0.01)
+            things_done.append('notify done')
+
+        @after('run')
+        async def audit(self):
+            things_done.append('audit started')
+            await asyncio.sleep(0)
+            things_done.append('audit done')
+
+        @after('sleep')
+        def snore(self):
+            things_done.append('snore')
+
+    things_done = []
+    robot = Robot()
+    robot.has_sneakers = False
+    run_coroutine(robot.run())
+    assert robot.is_sleeping
+
+    robot.has_sneakers = True
+    run_coroutine(robot.run())
+    assert robot.is_running
+    # the after callbacks ran together
+    eq_(things_done, ['notify started', 'audit started', 'audit done', 'notify done'])
+
+    run_coroutine(robot.sleep())
+    eq_(things_done[-1], 'snore')
+
+    with assert_raises(InvalidStateTransition):
+        run_coroutine(robot.sleep())
+
+    robots = [Robot(), Robot()]
+    robots[0].has_sneakers, robots[1].has_sneakers = True, False
+    result = run_coroutine(Robot.fire_many('run', robots))
+    eq_(result.accepted, robots[:1])
+    eq_(result.vetoed, robots[1:])
+
+
+def test_asynchronous_after_callback_errors():
+    @acts_as_state_machine(asynchronous=True, concurrent_after_callbacks=True, after_callback_errors='log')
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+        @after('run')
+        async def fail(self):
+            raise RuntimeError
+
+        @after('run')
+        async def notify(self):
+            things_done.append('notify')
+
+    things_done = []
+    robot = Robot()
+    run_coroutine(robot.run())
+    assert robot.is_running
+    eq_(things_done, ['notify'])
+
+
+def test_asynchronous_deferred_after_callbacks():
+    from concurrent.futures import ThreadPoolExecutor
+
+    @acts_as_state_machine(asynchronous=True, after_executor=ThreadPoolExecutor(max_workers=2))
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+        @after('run')
+        async def notify(self):
+            await asyncio.sleep(0)
+            things_done.append('notify')
+
+    things_done = []
+    robot = Robot()
+    run_coroutine(robot.run())
+    assert robot.is_running
+    # the coroutine was run to completion on the worker, not just created
+    Robot.after_executor.flush()
+    eq_(things_done, ['notify'])
+    Robot.after_executor.shutdown()
@@ -0,0 +1,370 @@
+"""Benchmarks for state_machine.
+
+Run the suite::
+
+    python benchmarks.py
+
+Store the results as a baseline, and later compare a run against it (exits with status 1
+when a benchmark got slower than the baseline by more than the tolerance)::
+
+    python benchmarks.py --save benchmarks_baseline.json
+    python benchmarks.py --compare benchmarks_baseline.json --tolerance 0.5
+
+Every timing is the best of several repeats, reported per operation; lower is better for
+every benchmark. Baselines are only comparable on the machine they were taken on. A new
+benchmark shows "(no baseline)" until benchmarks_baseline.json is saved again, so save it
+in the change that adds the benchmark.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+try:
+    import sqlalchemy
+    from sqlalchemy.orm import declarative_base, sessionmaker
+except ImportError:
+    sqlalchemy = None
+
+from state_machine import acts_as_state_machine, before, after, State, Event, instrumentation
+
+
+def build_robot():
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+        charging = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+        charge = Event(from_states=(running, cleaning), to_state=charging)
+        sleep = Event(from_states=(running, cleaning, charging), to_state=sleeping)
+
+    return Robot
+
+
+def build_robot_with_callbacks():
+    @acts_as_state_machine
+    class Robot(object):
+        sleeping = State(initial=True)
+        running = State()
+        charging = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        charge = Event(from_states=running, to_state=charging)
+        sleep = Event(from_states=(running, charging), to_state=sleeping)
+
+        @before('run')
+        def check_battery(self):
+            pass
+
+        @after('sleep')
+        def snore(self):
+            pass
+
+    return Robot
+
+
+def robot_source(states, events, callbacks, lazy=False):
+    # a class with a chain of states, an event from every state to the next one, and callbacks
+    # spread over the events
+    lines = ["@acts_as_state_machine(lazy=True)" if lazy else "@acts_as_state_machine", "class Robot(object):"]
+    for i in range(states):
+        lines.append("    state_{} = State(initial={})".format(i, i == 0))
+    for i in range(events):
+        lines.append("    event_{} = Event(from_states=state_{}, to_state=state_{})".format(
+            i, i % states, (i + 1) % states))
+    for i in range(callbacks):
+        lines.append("    @before('event_{}')".format(i % events))
+        lines.append("    def callback_{}(self): pass".format(i))
+    return compile("\n".join(lines), '<robot>', 'exec')
+
+
+def best_of(func, number, repeat=5):
+    # seconds per call, from the fastest of several repeats
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def ns(seconds):
+    return seconds * 1e9
+
+
+def bench_guard(number):
+    # The guard as it used to be: scan a tuple of State objects with State.__eq__,
+    # against the compiled frozenset of state names
+    Robot = build_robot()
+    from_states = (Robot.running, Robot.cleaning, Robot.charging)
+    from_state_names = frozenset(state.name for state in from_states)
+    current_state = 'charging'
+
+    def scan():
+        return current_state not in from_states
+
+    def lookup():
+        return current_state not in from_state_names
+
+    return [
+        ('guard: tuple scan', ns(best_of(scan, number)), 'ns/op'),
+        ('guard: frozenset lookup', ns(best_of(lookup, number)), 'ns/op'),
+    ]
+
+
+def bench_decoration(number):
+    namespace = dict(acts_as_state_machine=acts_as_state_machine, before=before, State=State, Event=Event)
+    results = []
+    for states, events, callbacks in [(4, 4, 0), (32, 32, 0), (128, 128, 0), (32, 32, 32), (32, 32, 256)]:
+        code = robot_source(states, events, callbacks)
+
+        def decorate():
+            exec(code, dict(namespace))
+
+        seconds = best_of(decorate, max(number // 20000, 1))
+        results.append(('decoration: {} states, {} events, {} callbacks'.format(states, events, callbacks),
+                        seconds * 1e6, 'us/op'))
+
+    code = robot_source(128, 128, 32, lazy=True)
+
+    def decorate_lazily():
+        exec(code, dict(namespace))
+
+    seconds = best_of(decorate_lazily, max(number // 20000, 1))
+    results.append(('decoration: lazy, 128 states, 128 events, 32 callbacks', seconds * 1e6, 'us/op'))
+    return results
+
+
+def bench_transition(number):
+    Robot = build_robot()
+    robot = Robot()
+
+    def cycle():
+        robot.run()
+        robot.charge()
+        robot.sleep()
+
+    CallbackRobot = build_robot_with_callbacks()
+    callback_robot = CallbackRobot()
+
+    def callback_cycle():
+        callback_robot.run()
+        callback_robot.charge()
+        callback_robot.sleep()
+
+    results = [
+        ('transition: no callbacks', ns(best_of(cycle, number)) / 3, 'ns/op'),
+        ('transition: with callbacks', ns(best_of(callback_cycle, number)) / 3, 'ns/op'),
+    ]
+
+    instrumentation.enable()
+    try:
+        results.append(('transition: instrumented', ns(best_of(cycle, number // 10)) / 3, 'ns/op'))
+    finally:
+        instrumentation.disable()
+        instrumentation.reset()
+    return results
+
+
+def bench_state_access(number):
+    Robot = build_robot()
+    robot = Robot()
+    robot.run()
+
+    def is_state():
+        return robot.is_running
+
+    def current_state():
+        return robot.current_state
+
+    robots = [Robot() for _ in range(1000)]
+    for other in robots[::2]:
+        other.run()
+
+    def loop():
+        return [other.is_running for other in robots]
+
+    def mask():
+        return Robot.mask_in_state(robots, 'running')
+
+    rounds = max(number // 1000, 1)
+    return [
+        ('access: is_<state>', ns(best_of(is_state, number)), 'ns/op'),
+        ('access: current_state', ns(best_of(current_state, number)), 'ns/op'),
+        ('access: is_<state> over 1000', ns(best_of(loop, rounds)) / 1000, 'ns/op'),
+        ('access: mask_in_state over 1000', ns(best_of(mask, rounds)) / 1000, 'ns/op'),
+    ]
+
+
+def bench_fire_many(number):
+    Robot = build_robot_with_callbacks()
+    robots = [Robot() for _ in range(1000)]
+
+    def loop():
+        for robot in robots:
+            robot.run()
+        for robot in robots:
+            robot.sleep()
+
+    def bulk():
+        Robot.fire_many('run', robots)
+        Robot.fire_many('sleep', robots)
+
+    rounds = max(number // 2000, 1)
+    return [
+        ('transition: loop over 1000', ns(best_of(loop, rounds)) / 2000, 'ns/op'),
+        ('transition: fire_many over 1000', ns(best_of(bulk, rounds)) / 2000, 'ns/op'),
+    ]
+
+
+def build_sqlite_robot(path, **options):
+    engine = sqlalchemy.create_engine('sqlite:///' + path)
+    Base = declarative_base()
+
+    @acts_as_state_machine(**options)
+    class Robot(Base):
+        __tablename__ = 'robots'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+        charging = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=(running, cleaning, charging), to_state=sleeping)
+
+    Base.metadata.create_all(engine)
+    return engine, Robot
+
+
+def bench_sqlite_state_storage(number, rows=200000):
+    # index size and filter speed of aasm_state stored as names vs. state_codes
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        for label, state_codes in [('names', None), ('codes', {'sleeping': 0, 'running': 1,
+                                                                'cleaning': 2, 'charging': 3})]:
+            options = {'state_codes': state_codes} if state_codes else {}
+            engine, Robot = build_sqlite_robot(os.path.join(directory, label + '.db'), **options)
+            state_codes = state_codes or {}
+            stored = [state_codes.get(name, name) for name in ('sleeping', 'running', 'cleaning', 'charging')]
+            with engine.begin() as connection:
+                connection.execute(Robot.__table__.insert(), [{'aasm_state': stored[i % 4]} for i in range(rows)])
+                pages_before = connection.exec_driver_sql('PRAGMA page_count').scalar()
+                connection.exec_driver_sql('CREATE INDEX ix_robots_aasm_state ON robots (aasm_state)')
+                pages_after = connection.exec_driver_sql('PRAGMA page_count').scalar()
+                page_size = connection.exec_driver_sql('PRAGMA page_size').scalar()
+
+            session = sessionmaker(bind=engine)()
+            query = session.query(Robot.id).filter(Robot.aasm_state == stored[1])
+            seconds = best_of(query.count, max(number // 20000, 1), repeat=3)
+            session.close()
+            engine.dispose()
+
+            results.append(('sqlite {} rows, {}: index size'.format(rows, label),
+                            (pages_after - pages_before) * page_size / 1024.0, 'KiB'))
+            results.append(('sqlite {} rows, {}: count in state'.format(rows, label), seconds * 1e3, 'ms/op'))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_sqlite_bulk_transition(number, rows=20000):
+    # a loaded loop of event calls and one flush, against one set-based UPDATE
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        engine, Robot = build_sqlite_robot(os.path.join(directory, 'bulk.db'))
+        with engine.begin() as connection:
+            connection.execute(Robot.__table__.insert(), [{'aasm_state': 'sleeping'} for _ in range(rows)])
+        Session = sessionmaker(bind=engine)
+
+        def orm_loop():
+            session = Session()
+            for robot in session.query(Robot).filter(Robot.aasm_state == 'sleeping'):
+                robot.run()
+            session.commit()
+            session.query(Robot).update({Robot.aasm_state: 'sleeping'})
+            session.commit()
+
+        def set_based():
+            session = Session()
+            Robot.bulk_transition(session, 'run')
+            session.commit()
+            session.query(Robot).update({Robot.aasm_state: 'sleeping'})
+            session.commit()
+
+        results.append(('sqlite {} rows: event loop + flush'.format(rows),
+                        ns(best_of(orm_loop, 1, repeat=3)) / rows, 'ns/row'))
+        results.append(('sqlite {} rows: bulk_transition'.format(rows),
+                        ns(best_of(set_based, 1, repeat=3)) / rows, 'ns/row'))
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def run(number):
+    benchmarks = [bench_guard, bench_decoration, bench_transition, bench_state_access, bench_fire_many]
+    if sqlalchemy is not None:
+        benchmarks += [bench_sqlite_state_storage, bench_sqlite_bulk_transition]
+    results = []
+    for benchmark in benchmarks:
+        results.extend(benchmark(number))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # print each result against its baseline; returns the names of the ones that regressed
+    regressions = []
+    for name, value, unit in results:
+        if name not in baseline:
+            print("{:<52} {:>10.1f} {:<6} (no baseline)".format(name, value, unit))
+            continue
+        change = value / baseline[name]['value'] - 1 if baseline[name]['value'] else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("{:<52} {:>10.1f} {:<6} {:>+7.1%}{}".format(name, value, unit, change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--number', type=int, default=200000, help="iterations of the fastest benchmarks")
+    parser.add_argument('--quick', action='store_true', help="a tenth of the iterations, for a smoke test")
+    parser.add_argument('--save', metavar='PATH', help="store the results as a baseline")
+    parser.add_argument('--compare', metavar='PATH', help="compare the results with a stored baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="slowdown against the baseline tolerated by --compare (default 0.5)")
+    args = parser.parse_args(argv)
+
+    results = run(args.number // 10 if args.quick else args.number)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(dict((name, {'value': round(value, 3), 'unit': unit}) for name, value, unit in results),
+                      baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("\n{} benchmark(s) regressed by more than {:.0%}".format(len(regressions), args.tolerance))
+            return 1
+        return 0
+
+    for name, value, unit in results:
+        print("{:<52} {:>10.1f} {}".format(name, value, unit))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
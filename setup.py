@@ -23,6 +23,9 @@ setup(name='state_machine',
       license='MIT',
       packages=get_packages(),
       zip_safe=False,
+      entry_points={
+          'console_scripts': ['state_machine_export = state_machine.export:main'],
+      },
       tests_require=['nose', 'pymongo'],
       test_suite='nose.collector',
       classifiers=[
@@ -1,49 +1,54 @@
-import inspect
+import functools
+import sys
 
-from state_machine.models import Event, State, InvalidStateTransition
+from state_machine.models import Event, State, InvalidStateTransition, TransitionConflict, GuardFailed, \
+    TransitionVetoed, BulkTransitionResult
 from state_machine.orm import get_adaptor
 
-_temp_callback_cache = None
+# name under which @before/@after collect callbacks in the namespace of the class being defined
+CALLBACKS_ATTRIBUTE = '_state_machine_callbacks'
 
-def get_callback_cache():
-    global _temp_callback_cache
-    if _temp_callback_cache is None:
-        _temp_callback_cache = dict()
-    return _temp_callback_cache
 
-def get_function_name(frame):
-    return inspect.getouterframes(frame)[1][3]
+def get_callback_cache(namespace):
+    # a class body has a namespace of its own, so the registry is scoped to the class
+    # being defined and no other thread or class can see it
+    if '__module__' not in namespace:
+        raise TypeError("@before and @after can only be used in a class body")
+    return namespace.setdefault(CALLBACKS_ATTRIBUTE, {'before': {}, 'after': {}})
+
 
 def before(before_what):
     def wrapper(func):
-        frame = inspect.currentframe()
-        calling_class = get_function_name(frame)
-
-        calling_class_dict = get_callback_cache().setdefault(calling_class, {'before': {}, 'after': {}})
-        calling_class_dict['before'].setdefault(before_what, []).append(func)
+        callback_cache = get_callback_cache(sys._getframe(1).f_locals)
+        callback_cache['before'].setdefault(before_what, []).append(func)
 
         return func
 
     return wrapper
 
 
-def after(after_what):
+def after(after_what, deferred=None):
+    # deferred: hand this callback to the class's after_executor (True), run it inline (False),
+    # or do whatever the class does by default (None)
     def wrapper(func):
-
-        frame = inspect.currentframe()
-        calling_class = get_function_name(frame)
-
-        calling_class_dict = get_callback_cache().setdefault(calling_class, {'before': {}, 'after': {}})
-        calling_class_dict['after'].setdefault(after_what, []).append(func)
+        callback_cache = get_callback_cache(sys._getframe(1).f_locals)
+        callback_cache['after'].setdefault(after_what, []).append(func)
+        if deferred is not None:
+            callback_cache.setdefault('deferred', {})[func] = deferred
 
         return func
 
     return wrapper
 
 
-def acts_as_state_machine(original_class):
-    adaptor = get_adaptor(original_class)
-    global _temp_callback_cache
-    modified_class = adaptor.modifed_class(original_class, _temp_callback_cache)
-    _temp_callback_cache = None
+def acts_as_state_machine(original_class=None, **options):
+    # usable bare, or called with options: @acts_as_state_machine(atomic_updates=True)
+    if original_class is None:
+        return functools.partial(acts_as_state_machine, **options)
+
+    adaptor = get_adaptor(original_class, **options)
+    callback_cache = original_class.__dict__.get(CALLBACKS_ATTRIBUTE)
+    if callback_cache is not None:
+        delattr(original_class, CALLBACKS_ATTRIBUTE)
+    modified_class = adaptor.modifed_class(original_class, callback_cache)
     return modified_class
@@ -0,0 +1,165 @@
+"""Coroutine event methods, for classes declared with acts_as_state_machine(asynchronous=True).
+
+Python 3 only; imported on demand by the adaptors.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import functools
+import inspect
+import logging
+
+from state_machine.instrumentation import metrics, clock, INVALID_STATE, VETOED
+from state_machine.models import InvalidStateTransition, GuardFailed, BulkTransitionResult
+
+logger = logging.getLogger(__name__)
+
+AFTER_CALLBACK_ERRORS = ('raise', 'log')
+
+
+def prepare_callbacks(callbacks):
+    # decide once per callback whether its result has to be awaited
+    return tuple((callback, inspect.iscoroutinefunction(callback)) for callback in callbacks)
+
+
+async def call(callback, is_coroutine, document):
+    if is_coroutine:
+        return await callback(document)
+    return callback(document)
+
+
+def run_coroutine_callback(callback, document):
+    # an after_executor worker has no event loop of its own, so the coroutine gets one
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(callback(document))
+    finally:
+        loop.close()
+
+
+def executor_callback(callback):
+    # what a deferred after callback hands to the after_executor, which only calls functions;
+    # a partial of module level functions still pickles for process pools
+    if inspect.iscoroutinefunction(callback):
+        return functools.partial(run_coroutine_callback, callback)
+    return callback
+
+
+def after_callbacks_runner(adaptor, event_name, afters):
+    if not adaptor.options.get('concurrent_after_callbacks'):
+        async def run_after_callbacks(document):
+            for callback, is_coroutine in afters:
+                await call(callback, is_coroutine, document)
+
+        return run_after_callbacks
+
+    errors = adaptor.options.get('after_callback_errors', 'raise')
+    if errors not in AFTER_CALLBACK_ERRORS:
+        raise ValueError("after_callback_errors must be one of {}".format(", ".join(AFTER_CALLBACK_ERRORS)))
+
+    async def run_after_callbacks(document):
+        # the after callbacks of an event are independent of each other, so they run together;
+        # every one of them gets to finish before a failure is reported
+        results = await asyncio.gather(*[call(callback, is_coroutine, document)
+                                         for callback, is_coroutine in afters], return_exceptions=True)
+        failures = [(callback, result) for (callback, _), result in zip(afters, results)
+                    if isinstance(result, BaseException)]
+        if not failures:
+            return
+        if errors == 'raise':
+            raise failures[0][1]
+        for callback, failure in failures:
+            logger.error("after callback %s of %s failed", callback.__name__, event_name, exc_info=failure)
+
+    return run_after_callbacks
+
+
+def event_method(adaptor, event_name, from_state_values, to_state_value, befores, afters, guard_check=None):
+    befores = prepare_callbacks(befores)
+    afters = prepare_callbacks(afters)
+    run_after_callbacks = after_callbacks_runner(adaptor, event_name, afters)
+    journal = adaptor.journal
+    memoize_guards = adaptor.options.get('memoize_guards')
+    to_state_name = adaptor.state_name(to_state_value)
+    class_name = adaptor.class_label
+
+    async def f(self):
+        timed = metrics.enabled
+        started = clock() if timed else None
+
+        #assert current state
+        state_value = self.aasm_state
+        if state_value not in from_state_values:
+            if timed:
+                metrics.rejection(class_name, event_name, INVALID_STATE)
+            raise InvalidStateTransition
+        if guard_check is not None and not guard_check(self):
+            if timed:
+                metrics.latency(class_name, event_name, 'guard', clock() - started)
+                metrics.rejection(class_name, event_name, VETOED)
+            raise GuardFailed
+        if timed:
+            metrics.latency(class_name, event_name, 'guard', clock() - started)
+
+        # fire before_change
+        if befores:
+            started = clock() if timed else None
+            for callback, is_coroutine in befores:
+                result = await call(callback, is_coroutine, self)
+                if result is False:
+                    if timed:
+                        metrics.latency(class_name, event_name, 'before', clock() - started)
+                        metrics.rejection(class_name, event_name, VETOED)
+                    return adaptor.vetoed(event_name, callback)
+            if timed:
+                metrics.latency(class_name, event_name, 'before', clock() - started)
+
+        #change state
+        started = clock() if timed else None
+        adaptor.transition(self, from_state_values, to_state_value)
+        if memoize_guards:
+            adaptor.forget_guards(self)
+        if journal is not None:
+            journal.record(adaptor.document_id(self), event_name, adaptor.state_name(state_value), to_state_name)
+        if timed:
+            metrics.latency(class_name, event_name, 'update', clock() - started)
+            metrics.transition(class_name, event_name)
+
+        #fire after_change
+        if afters:
+            started = clock() if timed else None
+            await run_after_callbacks(self)
+            if timed:
+                metrics.latency(class_name, event_name, 'after', clock() - started)
+        return True
+
+    return f
+
+
+def fire_many_method(adaptor):
+    async def fire_many(cls, event_name, documents):
+        accepted, rejected, vetoed, from_state_values, to_state_value, befores, afters = \
+            adaptor.partition(event_name, documents)
+        befores = prepare_callbacks(befores)
+        afters = prepare_callbacks(afters)
+        run_after_callbacks = after_callbacks_runner(adaptor, event_name, afters)
+
+        # each before callback runs over the whole batch at once, dropping the documents it vetoes
+        for callback, is_coroutine in befores:
+            results = await asyncio.gather(*[call(callback, is_coroutine, document) for document in accepted])
+            still_accepted = []
+            for document, result in zip(accepted, results):
+                (vetoed if result is False else still_accepted).append(document)
+            accepted = still_accepted
+
+        accepted = adaptor.bulk_transition_documents(event_name, accepted, rejected,
+                                                     from_state_values, to_state_value)
+
+        if afters:
+            await asyncio.gather(*[run_after_callbacks(document) for document in accepted])
+
+        if metrics.enabled:
+            adaptor.count_bulk_transition(event_name, accepted, rejected, vetoed)
+        return BulkTransitionResult(accepted, rejected, vetoed)
+
+    return fire_many
@@ -0,0 +1,117 @@
+"""Static analysis of a compiled state machine: reachability, unreachable and terminal states,
+and shortest event paths.
+
+Works on the transition table alone, {state name: {event name: to state name}}. Sets of
+states are bitsets (plain ints, one bit per state), so the reachability closure of machines
+with hundreds of states stays cheap. It is computed on the first can_reach or shortest_path
+query and kept.
+
+A parent state counts as being in any of its substates: it is reached when one of them is,
+left when an event leaves one of them, and a path to it ends in any of them.
+"""
+from __future__ import absolute_import
+
+from collections import deque
+
+
+class Reachability(object):
+
+    def __init__(self, states, transition_table, initial_states, descendants=None):
+        # descendants: {state name: the names of the state and of its substates, at any depth}
+        self.states = tuple(sorted(states))
+        self.transition_table = transition_table
+        self.descendants = dict((name, frozenset((descendants or {}).get(name, (name,)))) for name in self.states)
+        self._indexes = dict((name, index) for index, name in enumerate(self.states))
+        self._adjacency = [0] * len(self.states)
+        for from_state, events in transition_table.items():
+            for to_state in events.values():
+                self._adjacency[self._indexes[from_state]] |= 1 << self._indexes[to_state]
+        # the bits of each state and its substates
+        self._masks = [self._mask(self.descendants[name]) for name in self.states]
+        self._closure = None
+        self._paths = {}
+
+        reachable = 0
+        for initial_state in initial_states:
+            reachable |= self._reachable_from(self._indexes[initial_state])
+        # states no event path leads to from an initial state, and states no event leaves
+        self.unreachable_states = frozenset(name for index, name in enumerate(self.states)
+                                            if not reachable & self._masks[index])
+        self.terminal_states = frozenset(name for name in self.states
+                                         if not any(transition_table.get(substate)
+                                                    for substate in self.descendants[name]))
+
+    def _mask(self, names):
+        mask = 0
+        for name in names:
+            mask |= 1 << self._indexes[name]
+        return mask
+
+    def _reachable_from(self, index):
+        # a breadth first search over the bitsets
+        reached = frontier = 1 << index
+        while frontier:
+            following = 0
+            while frontier:
+                lowest = frontier & -frontier
+                following |= self._adjacency[lowest.bit_length() - 1]
+                frontier ^= lowest
+            frontier = following & ~reached
+            reached |= frontier
+        return reached
+
+    def closure(self):
+        # [bitset of the states reachable from each state, itself included] (Warshall's algorithm)
+        if self._closure is None:
+            closure = [adjacency | 1 << index for index, adjacency in enumerate(self._adjacency)]
+            for index in range(len(closure)):
+                row, bit = closure[index], 1 << index
+                closure = [reached | row if reached & bit else reached for reached in closure]
+            self._closure = closure
+        return self._closure
+
+    def index(self, state):
+        try:
+            return self._indexes[getattr(state, 'name', state)]
+        except KeyError:
+            raise ValueError("unknown state {}".format(state))
+
+    def can_reach(self, from_state, to_state):
+        closure = self.closure()
+        mask = self._masks[self.index(to_state)]
+        from_states = self.descendants[self.states[self.index(from_state)]]
+        return any(closure[self._indexes[name]] & mask for name in from_states)
+
+    def shortest_path(self, from_state, to_state):
+        # the fewest events leading from one state to the other, as a tuple of event names,
+        # or None when there is no way there
+        if not self.can_reach(from_state, to_state):
+            return None
+        from_state = self.states[self.index(from_state)]
+        to_state = self.states[self.index(to_state)]
+
+        paths = self._paths.get(from_state)
+        if paths is None:
+            # {state: (state before it, event)} along the shortest paths from from_state and
+            # its substates, and the states in the order they were reached
+            sources = sorted(self.descendants[from_state])
+            previous = dict((source, None) for source in sources)
+            order = list(sources)
+            queue = deque(sources)
+            while queue:
+                state = queue.popleft()
+                for event_name, next_state in sorted(self.transition_table.get(state, {}).items()):
+                    if next_state not in previous:
+                        previous[next_state] = (state, event_name)
+                        order.append(next_state)
+                        queue.append(next_state)
+            paths = self._paths[from_state] = (previous, order)
+
+        previous, order = paths
+        targets = self.descendants[to_state]
+        state = next(state for state in order if state in targets)
+        path = []
+        while previous[state] is not None:
+            state, event_name = previous[state]
+            path.append(event_name)
+        return tuple(reversed(path))
@@ -0,0 +1,88 @@
+"""Executors that run after callbacks off the caller's thread.
+
+A class declared with ``acts_as_state_machine(after_executor=...)`` hands its after
+callbacks to one of these and returns as soon as the state has changed. Anything with
+``submit(callback, document)``, ``flush(timeout=None)`` and ``shutdown(wait=True)``
+will do; a plain ``concurrent.futures`` executor is wrapped in a DeferredExecutor.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredExecutor(object):
+    """Runs callbacks on a ``concurrent.futures`` executor (a thread pool by default)."""
+
+    def __init__(self, executor=None):
+        if executor is None:
+            executor = futures.ThreadPoolExecutor(max_workers=4)
+        self.executor = executor
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._failures = []
+
+    def submit(self, callback, document):
+        future = self.executor.submit(callback, document)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                logger.error("deferred after callback failed", exc_info=future.exception())
+                self._failures.append(future.exception())
+
+    def flush(self, timeout=None):
+        # wait for everything submitted so far, then raise the first failure since the last flush
+        with self._lock:
+            pending = list(self._pending)
+        futures.wait(pending, timeout=timeout)
+        with self._lock:
+            failures, self._failures = self._failures, []
+        if failures:
+            raise failures[0]
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.flush()
+        self.executor.shutdown(wait=wait)
+
+
+class QueueExecutor(object):
+    """Puts ``(callback, document)`` pairs on a queue for workers of your own to run.
+
+    Workers must call ``queue.task_done()`` for every pair they take, so that flush can
+    wait for them with ``queue.join()``.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def submit(self, callback, document):
+        self.queue.put((callback, document))
+
+    def flush(self, timeout=None):
+        # Queue.join cannot time out, so neither can this
+        self.queue.join()
+
+    def shutdown(self, wait=True):
+        if wait:
+            self.flush()
+
+
+def get_executor(executor):
+    # accept a bare concurrent.futures executor as well as the executors above
+    if hasattr(executor, 'flush'):
+        return executor
+    return DeferredExecutor(executor)
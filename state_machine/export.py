@@ -0,0 +1,136 @@
+"""Export decorated classes to Graphviz DOT and JSON.
+
+Everything comes from the class itself (its State members and the compiled transition
+table), so nothing is instantiated and no database is touched::
+
+    state_machine_export --format dot myapp.models:Order > order.dot
+    state_machine_export --format json myapp.models myapp.billing
+
+A target is a module, for every state machine class defined in it, or module:Class.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import importlib
+import inspect
+import json
+import sys
+
+from state_machine.models import State
+
+
+def is_state_machine(clazz):
+    return inspect.isclass(clazz) and isinstance(getattr(clazz, 'transition_table', None), dict)
+
+
+def machine_states(clazz):
+    # {name: State} for the states of a decorated class, inherited ones included
+    states = {}
+    for klass in reversed(inspect.getmro(clazz)):
+        for name, value in vars(klass).items():
+            if isinstance(value, State):
+                states[name] = value
+    return states
+
+
+def to_dict(clazz):
+    # the compact JSON schema: states, initial states, [from, event, to] transitions, and the
+    # parents and regions of the states that have one
+    states = machine_states(clazz)
+    transition_table = clazz.transition_table
+    machine = {
+        'name': clazz.__name__,
+        'states': sorted(states),
+        'initial': sorted(name for name, state in states.items() if state.initial),
+        'transitions': sorted([from_state, event_name, to_state]
+                              for from_state, events in transition_table.items()
+                              for event_name, to_state in events.items()),
+    }
+    parents = dict((name, state.parent.name) for name, state in states.items() if state.parent is not None)
+    if parents:
+        machine['parents'] = parents
+    regions = dict((name, region) for name, region in clazz.state_regions.items() if region is not None)
+    if regions:
+        machine['regions'] = regions
+    return machine
+
+
+def to_json(clazz, **kwargs):
+    return json.dumps(to_dict(clazz), sort_keys=True, **kwargs)
+
+
+def _quote(name):
+    return '"{}"'.format(str(name).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def to_dot(clazz):
+    machine = to_dict(clazz)
+    # the same terminal states as the analysis, where a parent is left through its substates
+    terminal_states = clazz.terminal_states
+    regions = machine.get('regions', {})
+
+    lines = ['digraph {} {{'.format(_quote(machine['name'])), '    rankdir=LR;']
+    # each region in a cluster of its own, the main one outside of any
+    for region in [None] + sorted(set(regions.values())):
+        indent = '    '
+        if region is not None:
+            lines.append('    subgraph {} {{'.format(_quote('cluster_' + region)))
+            lines.append('        label={};'.format(_quote(region)))
+            indent = '        '
+        for name in machine['states']:
+            if regions.get(name) != region:
+                continue
+            shape = 'doublecircle' if name in terminal_states else 'ellipse'
+            lines.append('{}{} [shape={}];'.format(indent, _quote(name), shape))
+            if name in machine['initial']:
+                lines.append('{}{} [shape=point];'.format(indent, _quote('__initial_' + name)))
+                lines.append('{}{} -> {};'.format(indent, _quote('__initial_' + name), _quote(name)))
+        if region is not None:
+            lines.append('    }')
+    for from_state, event_name, to_state in machine['transitions']:
+        lines.append('    {} -> {} [label={}];'.format(_quote(from_state), _quote(to_state), _quote(event_name)))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def find_machines(target):
+    # the decorated classes named by a target: module:Class, or every one defined in a module
+    module_name, _, class_name = target.partition(':')
+    module = importlib.import_module(module_name)
+    if class_name:
+        clazz = getattr(module, class_name, None)
+        if not is_state_machine(clazz):
+            raise ValueError("{} is not a state machine class".format(target))
+        return [clazz]
+    return [clazz for _, clazz in sorted(vars(module).items())
+            if is_state_machine(clazz) and clazz.__module__ == module.__name__]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('targets', nargs='+', metavar='TARGET', help="module or module:Class")
+    parser.add_argument('--format', choices=('dot', 'json'), default='dot')
+    parser.add_argument('-o', '--output', metavar='PATH', help="write to a file rather than stdout")
+    args = parser.parse_args(argv)
+
+    try:
+        machines = [clazz for target in args.targets for clazz in find_machines(target)]
+    except (ImportError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.format == 'json':
+        output = json.dumps(dict(('{}:{}'.format(clazz.__module__, clazz.__name__), to_dict(clazz))
+                                 for clazz in machines), sort_keys=True, indent=2) + '\n'
+    else:
+        output = ''.join(to_dot(clazz) for clazz in machines)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
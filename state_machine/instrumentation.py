@@ -0,0 +1,164 @@
+"""Counts and latency histograms for transitions, per class, event and phase.
+
+Off by default. While disabled an event method pays for one attribute check; turn it on
+and off at any time, without redefining classes::
+
+    from state_machine import instrumentation
+
+    instrumentation.enable()
+    ...
+    print(instrumentation.to_prometheus())
+
+Series are labelled with the class's module and qualified name, e.g.
+``class="myapp.models.Order"``. The phases of a transition are ``guard``, ``before`` (the before callbacks), ``update``
+(the adaptor writing the new state) and ``after`` (the after callbacks).
+"""
+from __future__ import absolute_import
+
+import threading
+from bisect import bisect_left
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PHASES = ('guard', 'before', 'update', 'after')
+
+# reasons a transition did not happen
+INVALID_STATE = 'invalid_state'
+VETOED = 'vetoed'
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def snapshot(self):
+        cumulative, buckets = 0, []
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'count': self.count, 'sum': self.sum}
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._transitions = {}
+            self._rejections = {}
+            self._latencies = {}
+
+    def transition(self, class_name, event_name, count=1):
+        key = (class_name, event_name)
+        with self._lock:
+            self._transitions[key] = self._transitions.get(key, 0) + count
+
+    def rejection(self, class_name, event_name, reason, count=1):
+        key = (class_name, event_name, reason)
+        with self._lock:
+            self._rejections[key] = self._rejections.get(key, 0) + count
+
+    def latency(self, class_name, event_name, phase, seconds):
+        key = (class_name, event_name, phase)
+        with self._lock:
+            histogram = self._latencies.get(key)
+            if histogram is None:
+                histogram = self._latencies[key] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        # a consistent copy of everything recorded so far, keyed by tuples of label values
+        with self._lock:
+            return {
+                'transitions': dict(self._transitions),
+                'rejections': dict(self._rejections),
+                'latencies': dict((key, histogram.snapshot()) for key, histogram in self._latencies.items()),
+            }
+
+
+metrics = Metrics()
+
+
+def enable():
+    metrics.enabled = True
+
+
+def disable():
+    metrics.enabled = False
+
+
+def reset():
+    metrics.reset()
+
+
+def snapshot():
+    return metrics.snapshot()
+
+
+def class_label(clazz):
+    # the class label of a series: module and qualified name, so that two classes called
+    # Order in different modules stay apart (python 2 classes only have __name__)
+    return '{}.{}'.format(clazz.__module__, getattr(clazz, '__qualname__', clazz.__name__))
+
+
+def _labels(**labels):
+    return ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+
+def _bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def to_prometheus(snapshot=None):
+    # the snapshot in the Prometheus text exposition format
+    if snapshot is None:
+        snapshot = metrics.snapshot()
+    lines = [
+        '# HELP state_machine_transitions_total Transitions that happened.',
+        '# TYPE state_machine_transitions_total counter',
+    ]
+    for (class_name, event_name), count in sorted(snapshot['transitions'].items()):
+        lines.append('state_machine_transitions_total{{{}}} {}'.format(
+            _labels(**{'class': class_name, 'event': event_name}), count))
+
+    lines.extend([
+        '# HELP state_machine_rejected_transitions_total Transitions refused by the guard or a before callback.',
+        '# TYPE state_machine_rejected_transitions_total counter',
+    ])
+    for (class_name, event_name, reason), count in sorted(snapshot['rejections'].items()):
+        lines.append('state_machine_rejected_transitions_total{{{}}} {}'.format(
+            _labels(**{'class': class_name, 'event': event_name, 'reason': reason}), count))
+
+    lines.extend([
+        '# HELP state_machine_transition_seconds Time spent in each phase of a transition.',
+        '# TYPE state_machine_transition_seconds histogram',
+    ])
+    for (class_name, event_name, phase), histogram in sorted(snapshot['latencies'].items()):
+        labels = {'class': class_name, 'event': event_name, 'phase': phase}
+        for bound, count in histogram['buckets']:
+            lines.append('state_machine_transition_seconds_bucket{{{}}} {}'.format(
+                _labels(le=_bound(bound), **labels), count))
+        lines.append('state_machine_transition_seconds_sum{{{}}} {!r}'.format(_labels(**labels), histogram['sum']))
+        lines.append('state_machine_transition_seconds_count{{{}}} {}'.format(_labels(**labels), histogram['count']))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,140 @@
+"""A bounded, in-memory journal of transitions.
+
+A class declared with ``acts_as_state_machine(journal=TransitionJournal(...))`` records
+every transition as (document id, event, from state, to state, timestamp). Entries live
+in a fixed-size ring buffer made of flat arrays, and can be batch-flushed to a sink
+(SqlAlchemySink, MongoSink, or anything with ``write(entries)``).
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+JournalEntry = namedtuple('JournalEntry', ['document_id', 'event', 'from_state', 'to_state', 'timestamp'])
+
+
+class TransitionJournal(object):
+
+    def __init__(self, capacity=1024, sink=None, flush_every=None):
+        # flush_every: with a sink, flush once this many entries are waiting (defaults to
+        # half the capacity); entries are also flushed before they would be overwritten
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.sink = sink
+        self.flush_every = flush_every or max(capacity // 2, 1)
+
+        # event and state names are stored as indexes into a table of names
+        self._names = []
+        self._name_indexes = {}
+        self._events = array('H', [0]) * capacity
+        self._from_states = array('H', [0]) * capacity
+        self._to_states = array('H', [0]) * capacity
+        self._timestamps = array('d', [0.0]) * capacity
+        self._document_ids = [None] * capacity
+
+        self._written = 0  # entries recorded since the journal was created
+        self._flushed = 0  # of which handed to the sink
+        self._lock = threading.RLock()
+
+    def _name_index(self, name):
+        index = self._name_indexes.get(name)
+        if index is None:
+            index = self._name_indexes[name] = len(self._names)
+            self._names.append(name)
+        return index
+
+    def record(self, document_id, event, from_state, to_state):
+        with self._lock:
+            if self.sink is not None and self._written - self._flushed >= self.capacity:
+                self._flush_from_record()
+            slot = self._written % self.capacity
+            self._events[slot] = self._name_index(event)
+            self._from_states[slot] = self._name_index(from_state)
+            self._to_states[slot] = self._name_index(to_state)
+            self._timestamps[slot] = time.time()
+            self._document_ids[slot] = document_id
+            self._written += 1
+            if self.sink is not None and self._written - self._flushed >= self.flush_every:
+                self._flush_from_record()
+
+    def _flush_from_record(self):
+        # the transition being recorded has already happened, so a failing sink must not fail
+        # it: the entries stay unflushed for the next flush, as long as the buffer keeps them
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("journal sink failed, %d entries left unflushed", self._written - self._flushed)
+
+    def _entries(self, start, stop):
+        names = self._names
+        entries = []
+        for position in range(start, stop):
+            slot = position % self.capacity
+            entries.append(JournalEntry(self._document_ids[slot], names[self._events[slot]],
+                                        names[self._from_states[slot]], names[self._to_states[slot]],
+                                        self._timestamps[slot]))
+        return entries
+
+    def entries(self):
+        # the entries still in the buffer, oldest first
+        with self._lock:
+            return self._entries(max(self._written - self.capacity, 0), self._written)
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    def flush(self):
+        # hand every entry the sink has not seen yet over to it, in one batch
+        with self._lock:
+            if self.sink is None:
+                return 0
+            start = max(self._flushed, self._written - self.capacity)
+            entries = self._entries(start, self._written)
+            if entries:
+                self.sink.write(entries)
+            self._flushed = self._written
+            return len(entries)
+
+
+def journal_table(metadata, name='state_transitions'):
+    # a table SqlAlchemySink can write to
+    import sqlalchemy
+    return sqlalchemy.Table(
+        name, metadata,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('document_id', sqlalchemy.String),
+        sqlalchemy.Column('event', sqlalchemy.String),
+        sqlalchemy.Column('from_state', sqlalchemy.String),
+        sqlalchemy.Column('to_state', sqlalchemy.String),
+        sqlalchemy.Column('timestamp', sqlalchemy.Float),
+    )
+
+
+class SqlAlchemySink(object):
+    """Writes journal entries to a table (see journal_table) with one executemany INSERT."""
+
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+
+    def write(self, entries):
+        rows = [dict(entry._asdict(), document_id=None if entry.document_id is None else str(entry.document_id))
+                for entry in entries]
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(), rows)
+
+
+class MongoSink(object):
+    """Writes journal entries to a pymongo collection with one insert_many."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def write(self, entries):
+        self.collection.insert_many([entry._asdict() for entry in entries], ordered=False)
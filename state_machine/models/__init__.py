@@ -1,35 +1,126 @@
+from collections import namedtuple
+
 try:
     string_type = basestring
 except NameError:
     string_type = str
 
+try:
+    from sys import intern
+except ImportError:
+    pass  # a builtin on python 2
+
 class InvalidStateTransition(Exception):
     pass
 
 
+class TransitionConflict(InvalidStateTransition):
+    # the stored state changed underneath the document (optimistic locking)
+    pass
+
+
+class GuardFailed(InvalidStateTransition):
+    # one of the event's guards returned a false value
+    pass
+
+
+class TransitionVetoed(InvalidStateTransition):
+    # a before callback returned False, with acts_as_state_machine(raise_on_veto=True)
+
+    def __init__(self, event_name, callback_name):
+        super(TransitionVetoed, self).__init__(event_name, callback_name)
+        self.event_name = event_name
+        self.callback_name = callback_name
+
+    def __str__(self):
+        return "{} was vetoed by {}".format(self.event_name, self.callback_name)
+
+
+# outcome of Class.fire_many: documents that transitioned, documents whose current
+# state does not allow the event, and documents a guard or a before callback blocked
+BulkTransitionResult = namedtuple('BulkTransitionResult', ['accepted', 'rejected', 'vetoed'])
+
+
+def bind_name(obj, name):
+    # names are given to states and events once, when the machine is compiled
+    name = intern(str(name))
+    if obj.name is not None and obj.name != name:
+        raise ValueError("{!r} is already named {}, it cannot also be {}".format(obj, obj.name, name))
+    object.__setattr__(obj, 'name', name)
+
+
 class State(object):
-    def __init__(self, initial=False, **kwargs):
-        self.initial = initial
+    __slots__ = ('initial', 'name', 'parent', 'region', '_hash')
 
-    def __eq__(self,other):
-        if isinstance(other, string_type):
-            return self.name == other
-        elif isinstance(other, State):
+    def __init__(self, initial=False, parent=None, region=None, **kwargs):
+        object.__setattr__(self, 'initial', initial)
+        object.__setattr__(self, 'name', None)
+        # the enclosing state: being in this state also counts as being in the parent, and the
+        # parent's events apply here too
+        object.__setattr__(self, 'parent', parent)
+        # the independent state machine of the class this state belongs to, stored in its own
+        # <region>_state field; None for the main one, stored in aasm_state
+        object.__setattr__(self, 'region', region)
+        # unhashable until named: the hash must never change under a dict or a set
+        object.__setattr__(self, '_hash', None)
+
+    def bind_name(self, name):
+        bind_name(self, name)
+        # hash like the name, so a state and its name find the same dict entry
+        object.__setattr__(self, '_hash', hash(self.name))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("State objects are immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("State objects are immutable")
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if self.name is None:
+            return False
+        if isinstance(other, State):
             return self.name == other.name
+        elif isinstance(other, string_type):
+            return self.name == other
         else:
             return False
 
-
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        if self._hash is None:
+            raise TypeError("unnamed State objects are unhashable, they are named when the class is decorated")
+        return self._hash
+
+    def __repr__(self):
+        return "<State {}>".format(self.name)
+
 
 class Event(object):
+    __slots__ = ('name', 'from_states', 'to_state', 'guards')
+
     def __init__(self, **kwargs):
-        self.to_state = kwargs.get('to_state', None)
-        self.from_states = tuple()
+        object.__setattr__(self, 'name', None)
+        object.__setattr__(self, 'to_state', kwargs.get('to_state', None))
+        # predicates called with the document, all of which must pass for the event to fire
+        object.__setattr__(self, 'guards', tuple(kwargs.get('guards', ())))
         from_state_args = kwargs.get('from_states', tuple())
         if isinstance(from_state_args, (tuple, list)):
-            self.from_states = tuple(from_state_args)
+            object.__setattr__(self, 'from_states', tuple(from_state_args))
         else:
-            self.from_states = (from_state_args,)
+            object.__setattr__(self, 'from_states', (from_state_args,))
+
+    def bind_name(self, name):
+        bind_name(self, name)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Event objects are immutable")
+
+    def __delattr__(self, key):
+        raise AttributeError("Event objects are immutable")
+
+    def __repr__(self):
+        return "<Event {}>".format(self.name)
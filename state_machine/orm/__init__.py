@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import threading
+
 from state_machine.orm.base import BaseAdaptor
 from state_machine.orm.mongoengine import get_mongo_adaptor
 from state_machine.orm.sqlalchemy import get_sqlalchemy_adaptor
@@ -7,20 +9,68 @@ from state_machine.orm.sqlalchemy import get_sqlalchemy_adaptor
 _adaptors = [get_mongo_adaptor, get_sqlalchemy_adaptor]
 
 
-def get_adaptor(original_class):
+def get_adaptor(original_class, **options):
     # if none, then just keep state in memory
     for get_adaptor in _adaptors:
-        adaptor = get_adaptor(original_class)
+        adaptor = get_adaptor(original_class, **options)
         if adaptor is not None:
             break
     else:
-        adaptor = NullAdaptor(original_class)
+        adaptor = NullAdaptor(original_class, **options)
     return adaptor
 
 
+class LazyMachineType(type):
+    # metaclass of the classes declared with lazy=True: their states and events are compiled
+    # the first time the class is instantiated or asked for a member it does not have yet
+
+    _lock = threading.Lock()
+
+    def compile_state_machine(cls):
+        # compiles the class, and any lazy class it inherits from; False if there was nothing left to do
+        pending = [klass for klass in cls.__mro__ if klass.__dict__.get('_lazy_state_machine') is not None]
+        if not pending:
+            return False
+        with LazyMachineType._lock:
+            for klass in reversed(pending):
+                if klass.__dict__.get('_lazy_state_machine') is None:
+                    continue
+                adaptor, original_class, callback_cache = klass.__dict__['_lazy_state_machine']
+                for key, value in adaptor.generated_members(original_class, callback_cache).items():
+                    setattr(klass, key, value)
+                delattr(klass, '_lazy_state_machine')
+        return True
+
+    def __getattr__(cls, name):
+        # dunder lookups (copy, pickle, doctest...) should not be enough to compile the class
+        if name.startswith('__') or not cls.compile_state_machine():
+            raise AttributeError(name)
+        return getattr(cls, name)
+
+    def __call__(cls, *args, **kwargs):
+        cls.compile_state_machine()
+        return super(LazyMachineType, cls).__call__(*args, **kwargs)
+
+
 class NullAdaptor(BaseAdaptor):
-    def extra_class_members(self, initial_state):
-        return {"aasm_state": initial_state.name}
 
-    def update(self, document, state_name):
-        document.aasm_state = state_name
+    # lazy: put off compiling the states and events until the class is first used
+    supported_options = BaseAdaptor.supported_options + ('lazy',)
+
+    def modifed_class(self, original_class, callback_cache):
+        if not self.options.get('lazy'):
+            return super(NullAdaptor, self).modifed_class(original_class, callback_cache)
+
+        metaclass = type(original_class)
+        if not issubclass(metaclass, LazyMachineType):
+            metaclass = LazyMachineType if metaclass is type else \
+                type('Lazy' + metaclass.__name__, (LazyMachineType, metaclass), {})
+        class_dict = self.original_class_dict(original_class)
+        class_dict['_lazy_state_machine'] = (self, original_class, callback_cache)
+        return metaclass(original_class.__name__, original_class.__bases__, class_dict)
+
+    def extra_class_members(self, initial_state, field='aasm_state'):
+        return {field: self.state_value(initial_state.name)}
+
+    def update(self, document, state_value):
+        document.aasm_state = state_value
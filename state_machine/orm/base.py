@@ -1,111 +1,754 @@
 from __future__ import absolute_import
 import inspect
-from state_machine.models import Event, State, InvalidStateTransition
+import logging
+from operator import attrgetter
+from state_machine.analysis import Reachability
+from state_machine.executors import get_executor
+from state_machine.instrumentation import metrics, clock, class_label, INVALID_STATE, VETOED
+from state_machine.models import Event, State, InvalidStateTransition, GuardFailed, TransitionVetoed, \
+    BulkTransitionResult
+
+logger = logging.getLogger(__name__)
+
+# instance attribute under which memoize_guards keeps {event name: (state value, result)}
+GUARD_CACHE_ATTRIBUTE = '_state_machine_guard_cache'
 
 
 class BaseAdaptor(object):
 
-    def __init__(self, original_class):
+    # options accepted by acts_as_state_machine(...) for classes handled by this adaptor
+    # state_codes: {state name: small integer} to store states as integers rather than names
+    # asynchronous: event methods are coroutines and callbacks may be coroutine functions
+    # concurrent_after_callbacks: with asynchronous, run an event's after callbacks together
+    # after_callback_errors: with concurrent_after_callbacks, 'raise' the first failure once
+    #   all of them have finished, or 'log' failures and carry on
+    # after_executor: run after callbacks on this executor (see state_machine.executors)
+    #   instead of on the caller's thread
+    # journal: a state_machine.journal.TransitionJournal recording every transition
+    # memoize_guards: remember the outcome of an event's guards per document until it next transitions
+    # raise_on_veto: raise TransitionVetoed when a before callback returns False, rather than
+    #   have the event method return False
+    supported_options = ('state_codes', 'asynchronous', 'concurrent_after_callbacks', 'after_callback_errors',
+                         'after_executor', 'journal', 'memoize_guards', 'raise_on_veto')
+
+    def __init__(self, original_class, **options):
+        unsupported = set(options) - set(self.supported_options)
+        if unsupported:
+            raise TypeError("{} does not support the option(s) {}".format(
+                self.__class__.__name__, ", ".join(sorted(unsupported))))
         self.original_class = original_class
+        self.options = options
+        self.state_codes = options.get('state_codes')
+        self.state_names = None
+        if self.state_codes is not None:
+            self.state_names = dict((code, name) for name, code in self.state_codes.items())
+        self.journal = options.get('journal')
+        # how the metrics of state_machine.instrumentation name the class
+        self.class_label = class_label(original_class)
+        self._machine_members = None
+        # {state name: frozenset of the names of the state and all its substates}
+        self.descendants = {}
+        self.after_executor = None
+        if options.get('after_executor') is not None:
+            self.after_executor = get_executor(options['after_executor'])
 
     def get_potential_state_machine_attributes(self, clazz):
-        return inspect.getmembers(clazz)
+        # the class and everything it inherits, read straight from the class dicts: unlike
+        # inspect.getmembers this runs no descriptors, so ORM attributes are left alone
+        members = {}
+        for klass in reversed(inspect.getmro(clazz)):
+            members.update(vars(klass))
+        return sorted(members.items(), key=lambda item: item[0])
+
+    def machine_members(self, original_class):
+        # the states and events of the class, from a single scan shared by process_states
+        # and process_events
+        if self._machine_members is None:
+            states, events = [], []
+            for member, value in self.get_potential_state_machine_attributes(original_class):
+                if isinstance(value, State):
+                    states.append((member, value))
+                elif isinstance(value, Event):
+                    events.append((member, value))
+            self._machine_members = states, events
+        return self._machine_members
+
+    def state_value(self, state_name):
+        # what is stored in aasm_state for a state: its name, or its code with state_codes
+        if self.state_codes is None:
+            return state_name
+        return self.state_codes[state_name]
+
+    def state_name(self, state_value):
+        if self.state_names is None:
+            return state_value
+        return self.state_names[state_value]
+
+    def state_values(self, states):
+        # the stored values of states given as State objects or names, substates included
+        names = set()
+        for state in states:
+            name = getattr(state, 'name', state)
+            names.update(self.descendants.get(name, (name,)))
+        return [self.state_value(name) for name in sorted(names)]
+
+    def region_field(self, region):
+        # the field a region is stored in
+        if region is None:
+            return 'aasm_state'
+        return '{}_state'.format(region)
+
+    def states_field(self, states):
+        # the one field that states given as State objects or names are stored in
+        fields = set(self.state_fields.get(getattr(state, 'name', state), 'aasm_state') for state in states)
+        if len(fields) > 1:
+            raise ValueError("the states are in different regions")
+        return fields.pop() if fields else 'aasm_state'
+
+    def state_index_fields(self):
+        # the fields of the index asked for with the state_index option, or None
+        state_index = self.options.get('state_index')
+        if not state_index:
+            return None
+        fields = ('aasm_state',) if state_index is True else tuple(state_index)
+        if 'aasm_state' not in fields:
+            raise ValueError("state_index must include aasm_state")
+        return fields
+
+    def document_id(self, document):
+        # how the journal identifies a document
+        return getattr(document, 'id', None)
 
     def process_states(self, original_class):
-        initial_state = None
         is_method_dict = dict()
-        for member, value in self.get_potential_state_machine_attributes(original_class):
+        declared = dict(self.machine_members(original_class)[0])
+        for member, value in declared.items():
+            #add its name to itself:
+            value.bind_name(member)
+        state_names = set(declared)
+
+        # precompute every state's substates, however deep, so that is_<state> and the event
+        # guards stay a single lookup for nested states
+        descendants = dict((member, set([member])) for member in state_names)
+        for member, value in declared.items():
+            parent = value.parent
+            while parent is not None:
+                if declared.get(parent.name) is not parent:
+                    raise ValueError("the parent of {} is not a state of this class".format(member))
+                descendants[parent.name].add(member)
+                parent = parent.parent
+        self.descendants = dict((member, frozenset(names)) for member, names in descendants.items())
+
+        # the field each state is stored in (substates are in the region of their parent),
+        # and the initial state of every region
+        self.state_fields = dict()
+        self.state_regions = dict()
+        self.initial_states = dict()
+        for member, value in sorted(declared.items()):
+            region = value.region
+            parent = value.parent
+            while parent is not None:
+                if parent.region is not None:
+                    if region is not None and region != parent.region:
+                        raise ValueError("{} is not in the region of its parent".format(member))
+                    region = parent.region
+                parent = parent.parent
+            field = self.region_field(region)
+            self.state_fields[member] = field
+            self.state_regions[member] = region
+            if value.initial:
+                if field in self.initial_states:
+                    raise ValueError("multiple initial states!")
+                self.initial_states[field] = value
+        missing = set(self.state_fields.values()) - set(self.initial_states)
+        if missing:
+            raise ValueError("no initial state for {}".format(", ".join(sorted(missing))))
 
-            if isinstance(value, State):
-                if value.initial:
-                    if initial_state is not None:
-                        raise ValueError("multiple initial states!")
-                    initial_state = value
+        if self.state_codes is not None:
+            if set(self.state_codes) != state_names:
+                raise ValueError("state_codes must give a code to every state, and only to states")
+            if len(set(self.state_codes.values())) != len(self.state_codes):
+                raise ValueError("state_codes must not give two states the same code")
 
-                #add its name to itself:
-                setattr(value, 'name', member)
+        for member in state_names:
+            is_method_string = "is_" + member
 
-                is_method_string = "is_" + member
+            def is_method_builder(state_value):
+                def f(self):
+                    return self.aasm_state == state_value
 
-                def is_method_builder(member):
-                    def f(self):
-                        return self.aasm_state == str(member)
+                return property(f)
 
-                    return property(f)
+            def is_parent_method_builder(state_values):
+                def f(self):
+                    return self.aasm_state in state_values
 
-                is_method_dict[is_method_string] = is_method_builder(member)
+                return property(f)
 
-        return is_method_dict, initial_state
+            def is_region_method_builder(field, state_values):
+                def f(self):
+                    return getattr(self, field) in state_values
+
+                return property(f)
+
+            if self.state_fields[member] != 'aasm_state':
+                is_method_dict[is_method_string] = is_region_method_builder(
+                    self.state_fields[member], frozenset(self.state_values([member])))
+            elif len(self.descendants[member]) == 1:
+                is_method_dict[is_method_string] = is_method_builder(self.state_value(member))
+            else:
+                is_method_dict[is_method_string] = is_parent_method_builder(frozenset(self.state_values([member])))
 
-    def process_events(self, original_class):
         _adaptor = self
+
+        def mask_in_state(cls, documents, *states):
+            # [document is in one of the states, for each document], in a single pass
+            values = frozenset(_adaptor.state_values(states))
+            field = _adaptor.states_field(states)
+            if field == 'aasm_state':
+                return [document.aasm_state in values for document in documents]
+            return [getattr(document, field) in values for document in documents]
+
+        is_method_dict['mask_in_state'] = classmethod(mask_in_state)
+        return is_method_dict, self.initial_states.get('aasm_state')
+
+    def process_events(self, original_class, callback_cache=None):
         event_method_dict = dict()
-        for member, value in self.get_potential_state_machine_attributes(original_class):
-            if isinstance(value, Event):
-                # Create event methods
-
-                def event_meta_method(event_name, event_description):
-                    def f(self):
-                        #assert current state
-                        if self.current_state not in event_description.from_states:
-                            raise InvalidStateTransition
-
-                        # fire before_change
-                        failed = False
-                        if self.__class__.callback_cache and \
-                                event_name in self.__class__.callback_cache[_adaptor.original_class.__name__]['before']:
-                            for callback in self.__class__.callback_cache[_adaptor.original_class.__name__]['before'][event_name]:
-                                result = callback(self)
-                                if result is False:
-                                    print("One of the 'before' callbacks returned false, breaking")
-                                    failed = True
-                                    break
-
-                        #change state
-                        if not failed:
-                            _adaptor.update(self, event_description.to_state.name)
-
-                            #fire after_change
-                            if self.__class__.callback_cache and \
-                                    event_name in self.__class__.callback_cache[_adaptor.original_class.__name__]['after']:
-                                for callback in self.__class__.callback_cache[_adaptor.original_class.__name__]['after'][event_name]:
-                                    callback(self)
-
-                    return f
-
-                event_method_dict[member] = event_meta_method(member, value)
-        return event_method_dict
+        transition_table = dict()
+        compiled_events = dict()
+        guard_checks = dict()
+        event_fields = dict()
 
-    def modifed_class(self, original_class, callback_cache):
+        # Resolve the callbacks registered for this class once, rather than on every transition
+        callback_cache = callback_cache or {}
+        before_callbacks = callback_cache.get('before', {})
+        after_callbacks = callback_cache.get('after', {})
+        deferred_callbacks = callback_cache.get('deferred', {})
 
-        class_name = original_class.__name__
-        class_dict = dict()
+        declared_states = dict(self.machine_members(original_class)[0])
+        for member, value in self.machine_members(original_class)[1]:
+            value.bind_name(member)
+            for state in value.from_states + (value.to_state,):
+                if state is None or declared_states.get(state.name) is not state:
+                    raise ValueError("{} uses {!r}, which is not a state of this class".format(member, state))
 
-        class_dict['callback_cache'] = callback_cache
+            # Compile the transition up front: the guard becomes a single
+            # frozenset lookup on the state name instead of a scan over State objects.
+            # An event from a parent state is also an event from each of its substates
+            from_state_names = frozenset(name for state in value.from_states
+                                         for name in self.descendants.get(state.name, (state.name,)))
+            to_state_name = value.to_state.name
+            for from_state_name in from_state_names:
+                transition_table.setdefault(from_state_name, {})[member] = to_state_name
+
+            field = self.state_fields.get(to_state_name, 'aasm_state')
+            if any(self.state_fields.get(name, 'aasm_state') != field for name in from_state_names):
+                raise ValueError("{} goes from one region to another".format(member))
+            event_fields[member] = field
+
+            # the method itself works on stored values, so the guard needs no decoding
+            from_state_values = frozenset(self.state_value(name) for name in from_state_names)
+            to_state_value = self.state_value(to_state_name)
+
+            compiled_events[member] = (from_state_values, to_state_value,
+                                       tuple(before_callbacks.get(member, ())),
+                                       tuple(self.after_callback(callback, deferred_callbacks.get(callback))
+                                             for callback in after_callbacks.get(member, ())))
+
+            guard_checks[member] = self.guard_check(member, value.guards, field)
+
+        self.compiled_events = compiled_events
+        self.guard_checks = guard_checks
+        self.event_fields = event_fields
+
+        # Create event methods
+        for member in compiled_events:
+            if event_fields[member] == 'aasm_state':
+                event_method_dict[member] = self.event_method(member, *compiled_events[member],
+                                                              guard_check=guard_checks[member])
+            else:
+                event_method_dict[member] = self.region_event_method(member)
+
+        if len(set(self.state_fields.values())) > 1:
+            event_method_dict['fire_parallel'] = self.fire_parallel_method()
+        event_method_dict['fire_many'] = classmethod(self.fire_many_method())
+        event_method_dict.update(self.available_events_members(original_class, transition_table))
+        event_method_dict.update(self.reachability_members(transition_table))
+        # only when asked for, so that a column or attribute of that name is left alone
+        if self.after_executor is not None:
+            event_method_dict['after_executor'] = self.after_executor
+        if self.journal is not None:
+            event_method_dict['journal'] = self.journal
+        return event_method_dict, transition_table
+
+    def available_events_members(self, original_class, transition_table):
+        # reverse index of the transition table, {stored state value: names of the events it allows},
+        # behind Class.events_from(state) and instance.available_events
+        events_by_state = dict((self.state_value(member), ()) for member, _ in self.machine_members(original_class)[0])
+        for state_name, events in transition_table.items():
+            events_by_state[self.state_value(state_name)] = tuple(sorted(events))
+        state_value = self.state_value
+        guard_checks = self.guard_checks
+
+        def events_from(cls, state):
+            try:
+                return events_by_state[state_value(getattr(state, 'name', state))]
+            except KeyError:
+                raise ValueError("unknown state {}".format(state))
+
+        # a document with no stored state, or one the class does not know, has no events
+        fields = sorted(set(self.state_fields.values()))
+        if len(fields) > 1:
+            def available_events(self):
+                # the events of the current state of every region whose guards pass
+                event_names = [event_name for field in fields
+                               for event_name in events_by_state.get(getattr(self, field), ())]
+                return tuple(sorted(event_name for event_name in event_names
+                                    if guard_checks[event_name] is None or guard_checks[event_name](self)))
+        elif not any(guard_checks.values()):
+            def available_events(self):
+                return events_by_state.get(self.aasm_state, ())
+        else:
+            def available_events(self):
+                # the events of the current state whose guards pass
+                return tuple(event_name for event_name in events_by_state.get(self.aasm_state, ())
+                             if guard_checks[event_name] is None or guard_checks[event_name](self))
+
+        return {'events_from': classmethod(events_from), 'available_events': property(available_events)}
+
+    def reachability_members(self, transition_table):
+        reachability = Reachability(self.state_fields, transition_table,
+                                    [state.name for state in self.initial_states.values()], self.descendants)
+
+        def can_reach(cls, from_state, to_state):
+            return reachability.can_reach(from_state, to_state)
+
+        def shortest_path(cls, from_state, to_state):
+            return reachability.shortest_path(from_state, to_state)
+
+        return {
+            'can_reach': classmethod(can_reach),
+            'shortest_path': classmethod(shortest_path),
+            'unreachable_states': reachability.unreachable_states,
+            'terminal_states': reachability.terminal_states,
+        }
+
+    def guard_check(self, event_name, guards, field='aasm_state'):
+        # a function telling whether all the guards of an event pass for a document, None without guards
+        if not guards:
+            return None
+
+        def check(document):
+            for guard in guards:
+                if not guard(document):
+                    return False
+            return True
+
+        if not self.options.get('memoize_guards'):
+            return check
+
+        def memoized_check(document):
+            # a cached outcome is only good for the state it was computed in
+            state_value = getattr(document, field)
+            cache = getattr(document, GUARD_CACHE_ATTRIBUTE, None)
+            if cache is None:
+                cache = {}
+                setattr(document, GUARD_CACHE_ATTRIBUTE, cache)
+            cached = cache.get(event_name)
+            if cached is not None and cached[0] == state_value:
+                return cached[1]
+            result = check(document)
+            cache[event_name] = (state_value, result)
+            return result
+
+        return memoized_check
+
+    def forget_guards(self, document):
+        # memoized guard outcomes only hold until the document transitions, even back into the
+        # same state
+        cache = getattr(document, GUARD_CACHE_ATTRIBUTE, None)
+        if cache:
+            cache.clear()
+
+    def after_callback(self, callback, deferred):
+        # deferred callbacks are swapped for one that just submits them to the executor
+        if deferred is None:
+            deferred = self.after_executor is not None
+        if not deferred:
+            return callback
+        if self.after_executor is None:
+            raise ValueError("{} is deferred, but the class has no after_executor".format(callback.__name__))
+
+        if self.options.get('asynchronous'):
+            from state_machine import aio
+            callback = aio.executor_callback(callback)
+        submit = self.after_executor.submit
+
+        def deferred_callback(document):
+            submit(callback, document)
+
+        return deferred_callback
+
+    def event_method(self, event_name, from_state_values, to_state_value, befores, afters, guard_check=None):
+        _adaptor = self
+        if self.options.get('asynchronous'):
+            from state_machine import aio
+            return aio.event_method(self, event_name, from_state_values, to_state_value, befores, afters,
+                                    guard_check)
+
+        journal = self.journal
+        memoize_guards = self.options.get('memoize_guards')
+        to_state_name = self.state_name(to_state_value)
+        class_name = self.class_label
+
+        def instrumented(self):
+            # the same steps as f below, timing each phase for state_machine.instrumentation
+            started = clock()
+            state_value = self.aasm_state
+            allowed = state_value in from_state_values
+            guarded = allowed and guard_check is not None and not guard_check(self)
+            metrics.latency(class_name, event_name, 'guard', clock() - started)
+            if not allowed:
+                metrics.rejection(class_name, event_name, INVALID_STATE)
+                raise InvalidStateTransition
+            if guarded:
+                metrics.rejection(class_name, event_name, VETOED)
+                raise GuardFailed
 
-        def current_state_method():
+            if befores:
+                started = clock()
+                try:
+                    for callback in befores:
+                        result = callback(self)
+                        if result is False:
+                            metrics.rejection(class_name, event_name, VETOED)
+                            return _adaptor.vetoed(event_name, callback)
+                finally:
+                    metrics.latency(class_name, event_name, 'before', clock() - started)
+
+            started = clock()
+            _adaptor.transition(self, from_state_values, to_state_value)
+            if memoize_guards:
+                _adaptor.forget_guards(self)
+            if journal is not None:
+                journal.record(_adaptor.document_id(self), event_name,
+                               _adaptor.state_name(state_value), to_state_name)
+            metrics.latency(class_name, event_name, 'update', clock() - started)
+            metrics.transition(class_name, event_name)
+
+            if afters:
+                started = clock()
+                try:
+                    for callback in afters:
+                        callback(self)
+                finally:
+                    metrics.latency(class_name, event_name, 'after', clock() - started)
+            return True
+
+        if not befores and not afters and guard_check is None:
             def f(self):
-                return self.aasm_state
-            return property(f)
+                if metrics.enabled:
+                    return instrumented(self)
+
+                #assert current state
+                state_value = self.aasm_state
+                if state_value not in from_state_values:
+                    raise InvalidStateTransition
+
+                #change state
+                _adaptor.transition(self, from_state_values, to_state_value)
+                if memoize_guards:
+                    _adaptor.forget_guards(self)
+                if journal is not None:
+                    journal.record(_adaptor.document_id(self), event_name,
+                                   _adaptor.state_name(state_value), to_state_name)
+                return True
+
+            return f
+
+        def f(self):
+            if metrics.enabled:
+                return instrumented(self)
+
+            #assert current state
+            state_value = self.aasm_state
+            if state_value not in from_state_values:
+                raise InvalidStateTransition
+            if guard_check is not None and not guard_check(self):
+                raise GuardFailed
+
+            # fire before_change
+            for callback in befores:
+                result = callback(self)
+                if result is False:
+                    return _adaptor.vetoed(event_name, callback)
+
+            #change state
+            _adaptor.transition(self, from_state_values, to_state_value)
+            if memoize_guards:
+                _adaptor.forget_guards(self)
+            if journal is not None:
+                journal.record(_adaptor.document_id(self), event_name,
+                               _adaptor.state_name(state_value), to_state_name)
+
+            #fire after_change
+            for callback in afters:
+                callback(self)
+            return True
+
+        return f
+
+    def region_event_method(self, event_name):
+        # events of regions other than the main one go through fire_parallel
+        if self.options.get('asynchronous'):
+            raise ValueError("regions are not supported with asynchronous")
+        _adaptor = self
+        event_names = (event_name,)
+
+        def f(self):
+            return _adaptor.fire_parallel(self, event_names)
+
+        return f
+
+    def fire_parallel_method(self):
+        _adaptor = self
+
+        def fire_parallel(self, *event_names):
+            return _adaptor.fire_parallel(self, event_names)
+
+        return fire_parallel
+
+    def fire_parallel(self, document, event_names):
+        # fire events of different regions as one transition: every state and guard is checked,
+        # then every before callback runs, before all the regions are written at once
+        steps = []
+        for event_name in event_names:
+            if event_name not in self.compiled_events:
+                raise ValueError("unknown event {}".format(event_name))
+            field = self.event_fields[event_name]
+            from_state_values, to_state_value, befores, afters = self.compiled_events[event_name]
+            steps.append((event_name, field, getattr(document, field), from_state_values, to_state_value,
+                          befores, afters))
+        if len(set(step[1] for step in steps)) != len(steps):
+            raise ValueError("fire_parallel takes at most one event per region")
+
+        class_name = self.class_label
+        timed = metrics.enabled
+        for event_name, field, state_value, from_state_values, _, _, _ in steps:
+            started = clock() if timed else None
+            allowed = state_value in from_state_values
+            guard_check = self.guard_checks[event_name]
+            guarded = allowed and guard_check is not None and not guard_check(document)
+            if timed:
+                metrics.latency(class_name, event_name, 'guard', clock() - started)
+            if not allowed:
+                if timed:
+                    metrics.rejection(class_name, event_name, INVALID_STATE)
+                raise InvalidStateTransition
+            if guarded:
+                if timed:
+                    metrics.rejection(class_name, event_name, VETOED)
+                raise GuardFailed
+
+        for event_name, _, _, _, _, befores, _ in steps:
+            if not befores:
+                continue
+            started = clock() if timed else None
+            try:
+                for callback in befores:
+                    if callback(document) is False:
+                        if timed:
+                            metrics.rejection(class_name, event_name, VETOED)
+                        return self.vetoed(event_name, callback)
+            finally:
+                if timed:
+                    metrics.latency(class_name, event_name, 'before', clock() - started)
+
+        # the regions are written together, so every event is charged the whole update
+        started = clock() if timed else None
+        self.transition_many(document, [(field, from_state_values, to_state_value)
+                                        for _, field, _, from_state_values, to_state_value, _, _ in steps])
+        if self.options.get('memoize_guards'):
+            self.forget_guards(document)
+        for event_name, _, state_value, _, to_state_value, _, _ in steps:
+            if self.journal is not None:
+                self.journal.record(self.document_id(document), event_name, self.state_name(state_value),
+                                    self.state_name(to_state_value))
+        if timed:
+            elapsed = clock() - started
+            for step in steps:
+                metrics.latency(class_name, step[0], 'update', elapsed)
+                metrics.transition(class_name, step[0])
+
+        for event_name, _, _, _, _, _, afters in steps:
+            if not afters:
+                continue
+            started = clock() if timed else None
+            try:
+                for callback in afters:
+                    callback(document)
+            finally:
+                if timed:
+                    metrics.latency(class_name, event_name, 'after', clock() - started)
+        return True
 
-        class_dict['current_state'] = current_state_method()
+    def vetoed(self, event_name, callback):
+        # what an event method does when one of its before callbacks returns False
+        logger.debug("%s.%s was vetoed by %s", self.original_class.__name__, event_name, callback.__name__)
+        if self.options.get('raise_on_veto'):
+            raise TransitionVetoed(event_name, callback.__name__)
+        return False
 
-        class_dict.update(original_class.__dict__)
+    def fire_many_method(self):
+        _adaptor = self
+        if self.options.get('asynchronous'):
+            from state_machine import aio
+            return aio.fire_many_method(self)
+
+        def fire_many(cls, event_name, documents):
+            accepted, rejected, vetoed, from_state_values, to_state_value, befores, afters = \
+                _adaptor.partition(event_name, documents)
+
+            # run each before callback over the whole batch, dropping the documents it vetoes
+            for callback in befores:
+                still_accepted = []
+                for document in accepted:
+                    (vetoed if callback(document) is False else still_accepted).append(document)
+                accepted = still_accepted
+
+            accepted = _adaptor.bulk_transition_documents(event_name, accepted, rejected,
+                                                          from_state_values, to_state_value)
+
+            for callback in afters:
+                for document in accepted:
+                    callback(document)
+
+            if metrics.enabled:
+                _adaptor.count_bulk_transition(event_name, accepted, rejected, vetoed)
+            return BulkTransitionResult(accepted, rejected, vetoed)
+
+        return fire_many
+
+    def partition(self, event_name, documents):
+        if event_name not in self.compiled_events:
+            raise ValueError("unknown event {}".format(event_name))
+        if self.event_fields[event_name] != 'aasm_state':
+            raise ValueError("{} is not an event of the main region".format(event_name))
+        from_state_values, to_state_value, befores, afters = self.compiled_events[event_name]
+
+        # validate every from state in one pass instead of raising per document, then
+        # set aside the documents the event's guards turn down
+        accepted, rejected, vetoed = [], [], []
+        for document in documents:
+            (accepted if document.aasm_state in from_state_values else rejected).append(document)
+        guard_check = self.guard_checks[event_name]
+        if guard_check is not None:
+            still_accepted = []
+            for document in accepted:
+                (still_accepted if guard_check(document) else vetoed).append(document)
+            accepted = still_accepted
+        return accepted, rejected, vetoed, from_state_values, to_state_value, befores, afters
+
+    def count_bulk_transition(self, event_name, accepted, rejected, vetoed):
+        class_name = self.class_label
+        for reason, documents in ((INVALID_STATE, rejected), (VETOED, vetoed)):
+            if documents:
+                metrics.rejection(class_name, event_name, reason, len(documents))
+        if accepted:
+            metrics.transition(class_name, event_name, len(accepted))
+
+    def bulk_transition_documents(self, event_name, accepted, rejected, from_state_values, to_state_value):
+        # move the accepted documents, handing the ones that lost a race over to rejected
+        if self.journal is not None:
+            previous_state_values = dict((id(document), document.aasm_state) for document in accepted)
+        lost = self.bulk_update(accepted, from_state_values, to_state_value)
+        if lost:
+            lost_ids = set(id(document) for document in lost)
+            accepted = [document for document in accepted if id(document) not in lost_ids]
+            rejected.extend(lost)
+        if self.options.get('memoize_guards'):
+            for document in accepted:
+                self.forget_guards(document)
+        if self.journal is not None:
+            to_state_name = self.state_name(to_state_value)
+            for document in accepted:
+                self.journal.record(self.document_id(document), event_name,
+                                    self.state_name(previous_state_values[id(document)]), to_state_name)
+        return accepted
+
+    def generated_members(self, original_class, callback_cache):
+        # everything acts_as_state_machine adds to the class
+        class_dict = dict()
+
+        class_dict['callback_cache'] = callback_cache
+
+        class_dict['current_state'] = self.current_state_property()
 
         # Get states
         state_method_dict, initial_state = self.process_states(original_class)
-        class_dict.update(self.extra_class_members(initial_state))
+        self.initial_state = initial_state
+        for field, region_initial_state in self.initial_states.items():
+            class_dict.update(self.extra_class_members(region_initial_state, field))
         class_dict.update(state_method_dict)
 
         # Get events
-        event_method_dict = self.process_events(original_class)
+        event_method_dict, transition_table = self.process_events(original_class, callback_cache)
         class_dict.update(event_method_dict)
+        class_dict['transition_table'] = transition_table
+        # {state name: its region, None for the main one}, inherited from the parent for substates
+        class_dict['state_regions'] = dict(self.state_regions)
+        return class_dict
+
+    def modifed_class(self, original_class, callback_cache):
+        class_dict = self.original_class_dict(original_class)
+        class_dict.update(self.generated_members(original_class, callback_cache))
+        return type(original_class.__name__, original_class.__bases__, class_dict)
+
+    def current_state_property(self):
+        if self.state_codes is None:
+            # no python frame on the way to the stored name
+            return property(attrgetter('aasm_state'))
 
-        clazz = type(class_name, original_class.__bases__, class_dict)
-        return clazz
+        state_names = self.state_names
+
+        def f(self):
+            return state_names[self.aasm_state]
+
+        return property(f)
+
+    def original_class_dict(self, original_class):
+        # the members the rebuilt class starts from, and its qualified name, which type() would
+        # otherwise make the bare class name
+        class_dict = dict(original_class.__dict__)
+        if hasattr(original_class, '__qualname__'):
+            class_dict['__qualname__'] = original_class.__qualname__
+        return class_dict
 
     def extra_class_members(self, initial_state):
         raise NotImplementedError
 
-    def update(self, document, state_name):
+    def update(self, document, state_value):
         raise NotImplementedError
+
+    def transition(self, document, from_state_values, state_value):
+        # adaptors that can check the stored state while writing the new one override this
+        self.update(document, state_value)
+
+    def transition_many(self, document, changes):
+        # write several regions at once: changes are (field, from state values, state value);
+        # adaptors that can do it in a single write override this
+        for field, from_state_values, state_value in changes:
+            if field == 'aasm_state':
+                self.update(document, state_value)
+            else:
+                setattr(document, field, state_value)
+
+    def bulk_update(self, documents, from_state_values, state_value):
+        # returns the documents that could not be moved after all (see transition)
+        lost = []
+        for document in documents:
+            try:
+                self.transition(document, from_state_values, state_value)
+            except InvalidStateTransition:
+                lost.append(document)
+        return lost
@@ -5,32 +5,98 @@ try:
 except ImportError as e:
     mongoengine = None
 
+from state_machine.models import InvalidStateTransition
 from state_machine.orm.base import BaseAdaptor
 
 
 class MongoAdaptor(BaseAdaptor):
 
-    def get_potential_state_machine_attributes(self, clazz):
-        # reimplementing inspect.getmembers to swallow ConnectionError
-        results = []
-        for key in dir(clazz):
-            try:
-                value = getattr(clazz, key)
-            except (AttributeError, mongoengine.MongoEngineConnectionError):
-                continue
-            results.append((key, value))
-        results.sort()
-        return results
+    # atomic_updates: write each transition with a single conditional update_one that only
+    # matches while the stored state is still one of the event's from states
+    # state_index: True to index aasm_state, or the fields of a compound index that
+    #   includes it, e.g. ('tenant_id', 'aasm_state')
+    supported_options = BaseAdaptor.supported_options + ('atomic_updates', 'state_index')
 
+    def original_class_dict(self, original_class):
+        # hand the document metaclass its meta again and let it recreate the automatic id field;
+        # copied as is, it adds a second id field and loaded documents come back without a pk
+        class_dict = dict(original_class.__dict__)
+        meta = dict(class_dict.pop('_meta', {}))
+        id_field = meta.pop('id_field', None)
+        if id_field in class_dict and not class_dict[id_field].primary_key:
+            del class_dict[id_field]
+        state_index_fields = self.state_index_fields()
+        if state_index_fields is not None:
+            meta['indexes'] = list(meta.get('indexes', ())) + [{'fields': list(state_index_fields)}]
+        class_dict['meta'] = meta
+        return class_dict
 
-    def extra_class_members(self, initial_state):
-        return {'aasm_state': mongoengine.StringField(default=initial_state.name)}
+    def generated_members(self, original_class, callback_cache):
+        class_dict = super(MongoAdaptor, self).generated_members(original_class, callback_cache)
+        _adaptor = self
 
-    def update(self, document, state_name):
-        document.aasm_state = state_name
+        def in_state(cls, *states, **filters):
+            return _adaptor.in_state(cls, *states, **filters)
 
+        def count_by_state(cls, **filters):
+            return _adaptor.count_by_state(cls, **filters)
 
-def get_mongo_adaptor(original_class):
+        class_dict['in_state'] = classmethod(in_state)
+        class_dict['count_by_state'] = classmethod(count_by_state)
+        return class_dict
+
+    def in_state(self, clazz, *states, **filters):
+        # a queryset of the documents in any of the states (and matching the filters)
+        filters[self.states_field(states) + '__in'] = self.state_values(states)
+        return clazz.objects(**filters)
+
+    def count_by_state(self, clazz, **filters):
+        # {state name: number of documents} for the main region, counted by the server with a $group
+        counts = dict((name, 0) for name, field in self.state_fields.items() if field == 'aasm_state')
+        pipeline = [{'$group': {'_id': '$aasm_state', 'count': {'$sum': 1}}}]
+        for group in clazz.objects(**filters).aggregate(pipeline):
+            if group['_id'] is not None:
+                counts[self.state_name(group['_id'])] = group['count']
+        return counts
+
+    def extra_class_members(self, initial_state, field='aasm_state'):
+        if self.state_codes is not None:
+            return {field: mongoengine.IntField(default=self.state_value(initial_state.name))}
+        return {field: mongoengine.StringField(default=initial_state.name)}
+
+    def document_id(self, document):
+        return document.pk
+
+    def update(self, document, state_value):
+        document.aasm_state = state_value
+
+    def transition(self, document, from_state_values, state_value):
+        if not self.options.get('atomic_updates') or document.pk is None:
+            return self.update(document, state_value)
+        self.transition_many(document, [('aasm_state', from_state_values, state_value)])
+
+    def transition_many(self, document, changes):
+        if not self.options.get('atomic_updates') or document.pk is None:
+            return super(MongoAdaptor, self).transition_many(document, changes)
+
+        # compare-and-set in one round trip: two workers racing the same document
+        # cannot both match, and the loser gets an InvalidStateTransition
+        query = {'_id': document.pk}
+        for field, from_state_values, _ in changes:
+            query[field] = {'$in': list(from_state_values)}
+        result = document._get_collection().update_one(
+            query, {'$set': dict((field, state_value) for field, _, state_value in changes)})
+        if result.matched_count == 0:
+            raise InvalidStateTransition
+
+        for field, _, state_value in changes:
+            setattr(document, field, state_value)
+            # already persisted, so a later save() must not write it again over a newer state
+            if field in document._changed_fields:
+                document._changed_fields.remove(field)
+
+
+def get_mongo_adaptor(original_class, **options):
     if mongoengine is not None and issubclass(original_class, mongoengine.Document):
-        return MongoAdaptor(original_class)
+        return MongoAdaptor(original_class, **options)
     return None
@@ -5,58 +5,225 @@ try:
     from sqlalchemy import inspection
     from sqlalchemy.orm import instrumentation
     from sqlalchemy.orm import Session
+    from sqlalchemy.orm.attributes import set_committed_value
 except ImportError:
     sqlalchemy = None
     instrumentation = None
 
+from state_machine.instrumentation import metrics, clock
+from state_machine.models import TransitionConflict
 from state_machine.orm.base import BaseAdaptor
 
 
 class SqlAlchemyAdaptor(BaseAdaptor):
-    def extra_class_members(self, initial_state):
-        return {'aasm_state': sqlalchemy.Column(sqlalchemy.String)}
 
-    def update(self, document, state_name):
-        document.aasm_state = state_name
+    # optimistic_locking: write each transition of a persistent object with a conditional
+    # UPDATE ... WHERE <primary key> AND aasm_state = :expected
+    # state_index: True to index aasm_state, or the columns of a composite index that
+    #   includes it, e.g. ('tenant_id', 'aasm_state')
+    supported_options = BaseAdaptor.supported_options + ('optimistic_locking', 'state_index')
+
+    def extra_class_members(self, initial_state, field='aasm_state'):
+        if self.state_codes is not None:
+            return {field: sqlalchemy.Column(sqlalchemy.SmallInteger)}
+        return {field: sqlalchemy.Column(sqlalchemy.String)}
+
+    def document_id(self, document):
+        identity = sqlalchemy.inspect(document).identity
+        if identity is not None and len(identity) == 1:
+            return identity[0]
+        return identity
+
+    def update(self, document, state_value):
+        document.aasm_state = state_value
+
+    def transition(self, document, from_state_values, state_value):
+        if not self.options.get('optimistic_locking'):
+            return self.update(document, state_value)
+        self.transition_many(document, [('aasm_state', from_state_values, state_value)])
+
+    def transition_many(self, document, changes):
+        session = Session.object_session(document)
+        identity = sqlalchemy.inspect(document).identity
+        if not self.options.get('optimistic_locking') or session is None or identity is None:
+            # not in the database yet, nothing to race against
+            return super(SqlAlchemyAdaptor, self).transition_many(document, changes)
+
+        table = self.original_class.__table__
+        mapper = sqlalchemy.inspect(self.original_class)
+        statement = sqlalchemy.update(table).where(
+            *[table.c[field] == getattr(document, field) for field, _, _ in changes] +
+            [column == value for column, value in zip(mapper.primary_key, identity)]
+        ).values(dict((field, state_value) for field, _, state_value in changes))
+        if session.execute(statement).rowcount == 0:
+            raise TransitionConflict
+
+        # already written, so the flush must not UPDATE it again
+        for field, _, state_value in changes:
+            set_committed_value(document, field, state_value)
+
+    def in_state(self, session, *states):
+        # a query for the rows in any of the states
+        clazz = self.original_class
+        column = getattr(clazz, self.states_field(states))
+        return session.query(clazz).filter(column.in_(self.state_values(states)))
+
+    def count_by_state(self, session, *criterion):
+        # {state name: number of rows} for the main region, counted by the database with a GROUP BY
+        clazz = self.original_class
+        counts = dict((name, 0) for name, field in self.state_fields.items() if field == 'aasm_state')
+        query = session.query(clazz.aasm_state, sqlalchemy.func.count()).filter(*criterion).group_by(clazz.aasm_state)
+        for state_value, count in query:
+            if state_value is not None:
+                counts[self.state_name(state_value)] = count
+        return counts
+
+    def create_state_index(self, fields):
+        table = self.original_class.__table__
+        missing = [field for field in fields if field not in table.c]
+        if missing:
+            raise ValueError("state_index: {} has no column(s) {}".format(table.name, ", ".join(missing)))
+        # an Index built from the columns of a table attaches itself to that table
+        sqlalchemy.Index('ix_{}_{}'.format(table.name, '_'.join(fields)), *[table.c[field] for field in fields])
+
+    def bulk_transition(self, session, event_name, *criterion, **kwargs):
+        # Fire an event with a single UPDATE ... WHERE aasm_state IN (...) AND <criterion>
+        # rather than loading every row into the session, returning the number of rows moved.
+        # With run_after_callbacks=True the transitioned rows are read back (through RETURNING
+        # where the backend supports it) and the event's after callbacks run on them.
+        run_after_callbacks = kwargs.pop('run_after_callbacks', False)
+        synchronize_session = kwargs.pop('synchronize_session', 'fetch')
+        if kwargs:
+            raise TypeError("unexpected keyword arguments {}".format(", ".join(sorted(kwargs))))
+
+        if event_name not in self.compiled_events:
+            raise ValueError("unknown event {}".format(event_name))
+        from_state_values, to_state_value, befores, afters = self.compiled_events[event_name]
+        if self.event_fields[event_name] != 'aasm_state':
+            raise ValueError("{} is not an event of the main region".format(event_name))
+        if befores:
+            raise ValueError("{} has before callbacks, which need loaded documents: use fire_many".format(event_name))
+        if self.guard_checks[event_name] is not None:
+            raise ValueError("{} has guards, which need loaded documents: use fire_many".format(event_name))
+
+        clazz = self.original_class
+        statement = sqlalchemy.update(clazz).where(
+            clazz.aasm_state.in_(sorted(from_state_values)), *criterion
+        ).values(aasm_state=to_state_value).execution_options(synchronize_session=synchronize_session)
+
+        if self.options.get('memoize_guards'):
+            # the loaded rows the UPDATE may move are not seen transitioning one by one
+            for document in list(session.identity_map.values()):
+                if isinstance(document, clazz):
+                    self.forget_guards(document)
+
+        # counted as transitions of the event, with one update (and after) latency per call;
+        # the rows the UPDATE passes over are never seen, so there are no rejections
+        class_name = self.class_label
+        timed = metrics.enabled
+        started = clock() if timed else None
+        if not (run_after_callbacks and afters):
+            moved = session.execute(statement).rowcount
+            if timed:
+                metrics.latency(class_name, event_name, 'update', clock() - started)
+                if moved:
+                    metrics.transition(class_name, event_name, moved)
+            return moved
+
+        primary_key = sqlalchemy.inspect(clazz).primary_key
+        dialect = session.get_bind().dialect
+        update_returning = getattr(dialect, 'update_returning', None)
+        if update_returning is None:
+            update_returning = getattr(dialect, 'full_returning', False)
+        if update_returning:
+            identities = session.execute(statement.returning(*primary_key)).all()
+            moved = len(identities)
+        else:
+            # lock the rows that can move, so that the UPDATE moves exactly those
+            identities = session.execute(
+                sqlalchemy.select(*primary_key).where(clazz.aasm_state.in_(sorted(from_state_values)), *criterion)
+                .with_for_update()
+            ).all()
+            moved = 0
+            if identities:
+                moved = session.execute(statement.where(self.identity_clause(identities))).rowcount
+
+        documents = self.load_documents(session, identities)
+        if moved != len(identities):
+            # the database cannot lock rows, and some were moved by someone else in between
+            documents = [document for document in documents if document.aasm_state == to_state_value]
+        if timed:
+            metrics.latency(class_name, event_name, 'update', clock() - started)
+            if moved:
+                metrics.transition(class_name, event_name, moved)
+            started = clock()
+        try:
+            for callback in afters:
+                for document in documents:
+                    callback(document)
+        finally:
+            if timed:
+                metrics.latency(class_name, event_name, 'after', clock() - started)
+        return moved
+
+    def identity_clause(self, identities):
+        primary_key = sqlalchemy.inspect(self.original_class).primary_key
+        if len(primary_key) == 1:
+            return primary_key[0].in_([identity[0] for identity in identities])
+        return sqlalchemy.tuple_(*primary_key).in_([tuple(identity) for identity in identities])
+
+    def load_documents(self, session, identities, chunk_size=500):
+        # the rows with these primary keys, one SELECT per chunk rather than one per row
+        documents = []
+        for start in range(0, len(identities), chunk_size):
+            statement = sqlalchemy.select(self.original_class).where(
+                self.identity_clause(identities[start:start + chunk_size])
+            ).execution_options(populate_existing=True)
+            documents.extend(session.execute(statement).scalars().all())
+        return documents
 
     def modifed_class(self, original_class, callback_cache):
-        class_dict = dict()
+        class_dict = self.generated_members(original_class, callback_cache)
 
-        class_dict['callback_cache'] = callback_cache
+        orig_init = original_class.__init__
+        initial_state_values = [(field, self.state_value(initial_state.name))
+                                for field, initial_state in self.initial_states.items()]
 
-        def current_state_method():
-            def f(self):
-                return self.aasm_state
+        def new_init(self, *args, **kwargs):
+            orig_init(self, *args, **kwargs)
+            for field, initial_state_value in initial_state_values:
+                setattr(self, field, initial_state_value)
 
-            return property(f)
+        class_dict['__init__'] = new_init
 
-        class_dict['current_state'] = current_state_method()
+        _adaptor = self
 
-        # Get states
-        state_method_dict, initial_state = self.process_states(original_class)
-        class_dict.update(self.extra_class_members(initial_state))
-        class_dict.update(state_method_dict)
+        def bulk_transition(cls, session, event_name, *criterion, **kwargs):
+            return _adaptor.bulk_transition(session, event_name, *criterion, **kwargs)
 
-        orig_init = original_class.__init__
+        class_dict['bulk_transition'] = classmethod(bulk_transition)
 
-        def new_init(self, *args, **kwargs):
-            orig_init(self, *args, **kwargs)
-            self.aasm_state = initial_state.name
+        def in_state(cls, session, *states):
+            return _adaptor.in_state(session, *states)
 
-        class_dict['__init__'] = new_init
+        def count_by_state(cls, session, *criterion):
+            return _adaptor.count_by_state(session, *criterion)
 
-        # Get events
-        event_method_dict = self.process_events(original_class)
-        class_dict.update(event_method_dict)
+        class_dict['in_state'] = classmethod(in_state)
+        class_dict['count_by_state'] = classmethod(count_by_state)
 
         for key in class_dict:
             setattr(original_class, key, class_dict[key])
 
+        state_index_fields = self.state_index_fields()
+        if state_index_fields is not None:
+            self.create_state_index(state_index_fields)
+
         return original_class
 
 
-def get_sqlalchemy_adaptor(original_class):
+def get_sqlalchemy_adaptor(original_class, **options):
     if sqlalchemy is not None and hasattr(original_class, '_sa_class_manager') and isinstance(
             original_class._sa_class_manager, instrumentation.ClassManager):
-        return SqlAlchemyAdaptor(original_class)
+        return SqlAlchemyAdaptor(original_class, **options)
     return None
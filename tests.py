@@ -1,4 +1,7 @@
 import os
+import sys
+import threading
+import timeit
 import nose
 import functools
 from pymongo import MongoClient
@@ -12,10 +15,16 @@ except ImportError:
     mongoengine = None
 
 
+# set AASM_MONGO_MOCK=1 to run the mongo tests against mongomock instead of a live server
+if os.environ.get('AASM_MONGO_MOCK'):
+    import mongomock
+    MongoClient = mongomock.MongoClient
+
+
 def establish_mongo_connection():
     mongo_name = os.environ.get('AASM_MONGO_DB_NAME', 'test_acts_as_state_machine')
     mongo_port = int(os.environ.get('AASM_MONGO_DB_PORT', 27017))
-    mongoengine.connect(mongo_name, port=mongo_port)
+    mongoengine.connect(mongo_name, port=mongo_port, mongo_client_class=MongoClient)
 
 try:
     import sqlalchemy
@@ -24,7 +33,8 @@ try:
 except ImportError:
     sqlalchemy = None
 
-from state_machine import acts_as_state_machine, before, State, Event, after, InvalidStateTransition
+from state_machine import acts_as_state_machine, before, State, Event, after, InvalidStateTransition, \
+    TransitionConflict, GuardFailed, TransitionVetoed
 
 
 def requires_mongoengine(func):
@@ -157,6 +167,858 @@ def test_multiple_machines():
     person.run()
     eq_(things_done, ["Person.ran"])
 
+def test_transition_table():
+    @acts_as_state_machine
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+        sleep = Event(from_states=(running, cleaning), to_state=sleeping)
+
+    eq_(Robot.transition_table, {
+        'sleeping': {'run': 'running'},
+        'running': {'cleanup': 'cleaning', 'sleep': 'sleeping'},
+        'cleaning': {'sleep': 'sleeping'},
+    })
+
+    robot = Robot()
+    with assert_raises(InvalidStateTransition):
+        robot.cleanup()
+    assert robot.is_sleeping
+
+def test_states_and_events_are_named_and_immutable():
+    @acts_as_state_machine
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+    eq_(Robot.sleeping.name, 'sleeping')
+    eq_(Robot.sleeping, 'sleeping')
+    assert Robot.sleeping != Robot.running
+
+    # states hash like their names, so either can be used as a key
+    durations = {Robot.sleeping: 8, Robot.running: 1}
+    eq_(durations['sleeping'], 8)
+    eq_(durations[Robot.running], 1)
+
+    # and only once named, so that a hash never changes under a dict or a set
+    with assert_raises(TypeError):
+        hash(State())
+
+    with assert_raises(AttributeError):
+        Robot.sleeping.initial = False
+    with assert_raises(AttributeError):
+        Event(from_states=Robot.sleeping, to_state=Robot.running).to_state = Robot.sleeping
+    with assert_raises(ValueError):
+        Robot.running.bind_name('walking')
+
+
+def test_callbacks_run_in_order_and_before_can_block():
+    @acts_as_state_machine
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+        @before('run')
+        def check_battery(self):
+            things_done.append('check_battery')
+
+        @before('run')
+        def check_sneakers(self):
+            things_done.append('check_sneakers')
+            return self.has_sneakers
+
+        @after('run')
+        def celebrate(self):
+            things_done.append('celebrate')
+
+    things_done = []
+    robot = Robot()
+    robot.has_sneakers = False
+    eq_(robot.run(), False)
+    assert robot.is_sleeping
+    eq_(things_done, ['check_battery', 'check_sneakers'])
+
+    things_done = []
+    robot.has_sneakers = True
+    eq_(robot.run(), True)
+    assert robot.is_running
+    eq_(things_done, ['check_battery', 'check_sneakers', 'celebrate'])
+
+
+def test_raise_on_veto():
+    @acts_as_state_machine(raise_on_veto=True)
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+        @before('run')
+        def check_sneakers(self):
+            return False
+
+    robot = Robot()
+    with assert_raises(TransitionVetoed) as context:
+        robot.run()
+    eq_(context.exception.callback_name, 'check_sneakers')
+    eq_(str(context.exception), 'run was vetoed by check_sneakers')
+    assert robot.is_sleeping
+
+
+def define_robot_with_callbacks(number_of_callbacks):
+    lines = [
+        "@acts_as_state_machine",
+        "class Robot(object):",
+        "    sleeping = State(initial=True)",
+        "    running = State()",
+        "    run = Event(from_states=sleeping, to_state=running)",
+    ]
+    for i in range(number_of_callbacks):
+        lines.append("    @before('run')")
+        lines.append("    def callback_{}(self): pass".format(i))
+    code = compile("\n".join(lines), '<robot>', 'exec')
+    namespace = dict(acts_as_state_machine=acts_as_state_machine, before=before, State=State, Event=Event)
+
+    def define():
+        exec(code, dict(namespace))
+
+    return define
+
+
+def test_callback_registration_cost_is_linear():
+    def cost_per_callback(number_of_callbacks):
+        seconds = min(timeit.repeat(define_robot_with_callbacks(number_of_callbacks), number=5, repeat=3))
+        return seconds / 5 / number_of_callbacks
+
+    small = cost_per_callback(50)
+    large = cost_per_callback(1000)
+
+    # registering a callback must not walk the stack or touch the source files,
+    # so the cost per callback stays flat (and tiny) as a class grows
+    assert large < small * 3, (small, large)
+    assert large < 50e-6, large
+
+def test_callbacks_are_scoped_to_the_class():
+    def make_robot(label):
+        @acts_as_state_machine
+        class Robot(object):
+            sleeping = State(initial=True)
+            running = State()
+
+            run = Event(from_states=sleeping, to_state=running)
+
+            @before('run')
+            def on_run(self):
+                things_done.append(label)
+
+        return Robot
+
+    things_done = []
+    robots = [None] * 20
+
+    def define(i):
+        robots[i] = make_robot(i)
+
+    threads = [threading.Thread(target=define, args=(i,)) for i in range(len(robots))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every class is called Robot, but each one only gets its own callback
+    for i, Robot in enumerate(robots):
+        Robot().run()
+    eq_(things_done, list(range(len(robots))))
+
+
+def test_callbacks_outside_class_body():
+    with assert_raises(TypeError):
+        @before('run')
+        def on_run(self):
+            pass
+
+def test_fire_many():
+    @acts_as_state_machine
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+
+        @before('run')
+        def check_sneakers(self):
+            return self.has_sneakers
+
+        @after('run')
+        def celebrate(self):
+            celebrated.append(self)
+
+    celebrated = []
+    robots = [Robot() for _ in range(4)]
+    for robot, has_sneakers in zip(robots, [True, True, False, True]):
+        robot.has_sneakers = has_sneakers
+    robots[3].run()
+    del celebrated[:]
+
+    result = Robot.fire_many('run', robots)
+    eq_(result.accepted, robots[:2])
+    eq_(result.rejected, robots[3:])
+    eq_(result.vetoed, robots[2:3])
+    eq_(celebrated, robots[:2])
+    eq_([robot.current_state for robot in robots], ['running', 'running', 'sleeping', 'running'])
+
+    with assert_raises(ValueError):
+        Robot.fire_many('fly', robots)
+
+def test_state_codes():
+    @acts_as_state_machine(state_codes={'sleeping': 0, 'running': 1, 'cleaning': 2})
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+
+    robot = Robot()
+    eq_(robot.aasm_state, 0)
+    eq_(robot.current_state, 'sleeping')
+    assert robot.is_sleeping
+    robot.run()
+    eq_(robot.aasm_state, 1)
+    eq_(robot.current_state, Robot.running)
+    assert robot.is_running
+    assert not robot.is_sleeping
+    with assert_raises(InvalidStateTransition):
+        robot.run()
+
+    with assert_raises(ValueError):
+        @acts_as_state_machine(state_codes={'sleeping': 0, 'running': 0})
+        class Robot():
+            sleeping = State(initial=True)
+            running = State()
+
+    with assert_raises(ValueError):
+        @acts_as_state_machine(state_codes={'sleeping': 0})
+        class Robot():
+            sleeping = State(initial=True)
+            running = State()
+
+def test_deferred_after_callbacks():
+    from concurrent.futures import ThreadPoolExecutor
+    from state_machine.executors import QueueExecutor
+
+    release = threading.Event()
+
+    @acts_as_state_machine(after_executor=ThreadPoolExecutor(max_workers=2))
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+        @after('run')
+        def send_email(self):
+            release.wait(5)
+            things_done.append('send_email')
+
+        @after('run', deferred=False)
+        def log(self):
+            things_done.append('log')
+
+        @after('sleep')
+        def fail(self):
+            raise RuntimeError
+
+    things_done = []
+    robot = Robot()
+    robot.run()
+    # returned before the deferred callback got to run
+    assert robot.is_running
+    eq_(things_done, ['log'])
+
+    release.set()
+    Robot.after_executor.flush()
+    eq_(things_done, ['log', 'send_email'])
+
+    robot.sleep()
+    with assert_raises(RuntimeError):
+        Robot.after_executor.flush()
+    Robot.after_executor.shutdown()
+
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+    callbacks = queue.Queue()
+
+    @acts_as_state_machine(after_executor=QueueExecutor(callbacks))
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+        @after('run', deferred=True)
+        def send_email(self):
+            things_done.append('queued send_email')
+
+    Robot().run()
+    callback, document = callbacks.get_nowait()
+    callback(document)
+    callbacks.task_done()
+    Robot.after_executor.flush()
+    eq_(things_done[-1], 'queued send_email')
+
+    with assert_raises(ValueError):
+        @acts_as_state_machine
+        class Robot():
+            sleeping = State(initial=True)
+            running = State()
+
+            run = Event(from_states=sleeping, to_state=running)
+
+            @after('run', deferred=True)
+            def send_email(self):
+                pass
+
+
+def test_transition_journal():
+    from state_machine.journal import TransitionJournal
+
+    class ListSink(object):
+        def __init__(self):
+            self.batches = []
+
+        def write(self, entries):
+            self.batches.append(entries)
+
+    sink = ListSink()
+
+    @acts_as_state_machine(journal=TransitionJournal(capacity=4, sink=sink, flush_every=3),
+                           state_codes={'sleeping': 0, 'running': 1})
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+    robot = Robot()
+    robot.id = 7
+    for _ in range(3):
+        robot.run()
+        robot.sleep()
+
+    entries = Robot.journal.entries()
+    eq_(len(Robot.journal), 4)
+    eq_([(entry.event, entry.from_state, entry.to_state) for entry in entries],
+        [('run', 'sleeping', 'running'), ('sleep', 'running', 'sleeping')] * 2)
+    eq_(set(entry.document_id for entry in entries), set([7]))
+
+    # flushed in batches of three, and the rest on demand
+    eq_([len(batch) for batch in sink.batches], [3, 3])
+    eq_(Robot.journal.flush(), 0)
+    Robot.fire_many('run', [robot, Robot()])
+    eq_(Robot.journal.flush(), 2)
+    eq_(sink.batches[-1][-1].from_state, 'sleeping')
+
+
+def test_transition_journal_failing_sink():
+    from state_machine.journal import TransitionJournal
+
+    class FlakySink(object):
+        def __init__(self):
+            self.batches = []
+            self.failures = 1
+
+        def write(self, entries):
+            if self.failures:
+                self.failures -= 1
+                raise IOError("sink unavailable")
+            self.batches.append(entries)
+
+    sink = FlakySink()
+
+    @acts_as_state_machine(journal=TransitionJournal(capacity=8, sink=sink, flush_every=2))
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+        @after('sleep')
+        def snore(self):
+            things_done.append('snore')
+
+    things_done = []
+    robot = Robot()
+    robot.run()
+    # the sink fails on this flush, and the transition still completes
+    robot.sleep()
+    assert robot.is_sleeping
+    eq_(things_done, ['snore'])
+    eq_(sink.batches, [])
+
+    # the entries that were not written go with the next batch
+    robot.run()
+    eq_([entry.event for entry in sink.batches[0]], ['run', 'sleep', 'run'])
+
+def test_instrumentation():
+    from state_machine import instrumentation
+
+    @acts_as_state_machine
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+        @before('sleep')
+        def check_tired(self):
+            return self.tired
+
+    # series are labelled with the module and qualified name, so classes of the same name stay apart
+    name = instrumentation.class_label(Robot)
+    eq_(name, '{}.{}'.format(__name__, getattr(Robot, '__qualname__', 'Robot')))
+    elsewhere = dict(__name__='elsewhere', acts_as_state_machine=acts_as_state_machine, State=State)
+    exec("@acts_as_state_machine\nclass Robot(object):\n    idle = State(initial=True)\n", elsewhere)
+    eq_(instrumentation.class_label(elsewhere['Robot']), 'elsewhere.Robot')
+
+    robot = Robot()
+    robot.tired = False
+    instrumentation.reset()
+    robot.run()
+    eq_(instrumentation.snapshot()['transitions'], {})
+
+    instrumentation.enable()
+    try:
+        robot.sleep()
+        robot.tired = True
+        robot.sleep()
+        with assert_raises(InvalidStateTransition):
+            robot.sleep()
+        robot.run()
+    finally:
+        instrumentation.disable()
+
+    snapshot = instrumentation.snapshot()
+    eq_(snapshot['transitions'], {(name, 'sleep'): 1, (name, 'run'): 1})
+    eq_(snapshot['rejections'], {(name, 'sleep', 'vetoed'): 1, (name, 'sleep', 'invalid_state'): 1})
+    eq_(snapshot['latencies'][(name, 'sleep', 'guard')]['count'], 3)
+    eq_(snapshot['latencies'][(name, 'sleep', 'before')]['count'], 2)
+    eq_(snapshot['latencies'][(name, 'sleep', 'update')]['count'], 1)
+    assert (name, 'run', 'after') not in snapshot['latencies']
+
+    text = instrumentation.to_prometheus(snapshot)
+    assert 'state_machine_transitions_total{class="' + name + '",event="run"} 1' in text
+    assert 'state_machine_rejected_transitions_total{class="' + name + '",event="sleep",reason="vetoed"} 1' in text
+    assert 'state_machine_transition_seconds_count{class="' + name + '",event="sleep",phase="guard"} 3' in text
+    assert 'state_machine_transition_seconds_bucket{class="' + name + '",event="sleep",le="+Inf",phase="guard"} 3' \
+        in text
+    instrumentation.reset()
+
+
+# async def is a syntax error on python 2
+if sys.version_info >= (3, 5):
+    from async_cases import test_asynchronous_state_machine, test_asynchronous_after_callback_errors, \
+        test_asynchronous_deferred_after_callbacks
+
+
+def test_guards():
+    def has_battery(robot):
+        checks.append('battery')
+        return robot.battery > 10
+
+    @acts_as_state_machine(memoize_guards=True)
+    class Robot():
+        sleeping = State(initial=True)
+        charging = State()
+        running = State()
+
+        charge = Event(from_states=sleeping, to_state=charging)
+        unplug = Event(from_states=charging, to_state=sleeping)
+        run = Event(from_states=(sleeping, charging), to_state=running, guards=[has_battery])
+
+        @before('run')
+        def wake_up(self):
+            things_done.append('wake up')
+
+    checks, things_done = [], []
+    robot = Robot()
+    robot.battery = 5
+    with assert_raises(GuardFailed):
+        robot.run()
+    robot.battery = 50
+    with assert_raises(GuardFailed):
+        robot.run()
+    # the guard ran once for the state, and blocked the event before its callbacks
+    eq_(checks, ['battery'])
+    eq_(things_done, [])
+    assert robot.is_sleeping
+
+    # a new state, so the guard is asked again
+    robot.charge()
+    robot.run()
+    assert robot.is_running
+    eq_(checks, ['battery', 'battery'])
+    eq_(things_done, ['wake up'])
+
+    robots = [Robot(), Robot()]
+    robots[0].battery, robots[1].battery = 50, 0
+    result = Robot.fire_many('run', robots)
+    eq_(result.accepted, robots[:1])
+    eq_(result.vetoed, robots[1:])
+
+    # any transition forgets the outcomes, even one back into the same state
+    robot = Robot()
+    robot.battery = 5
+    eq_(robot.available_events, ('charge',))
+    robot.charge()
+    robot.battery = 50
+    robot.unplug()
+    eq_(robot.available_events, ('charge', 'run'))
+    robot.run()
+    assert robot.is_running
+
+
+def test_available_events():
+    @acts_as_state_machine(state_codes={'sleeping': 0, 'running': 1, 'broken': 2})
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+        broken = State()
+
+        run = Event(from_states=sleeping, to_state=running,
+                    guards=[lambda robot: robot.battery > 10])
+        sleep = Event(from_states=running, to_state=sleeping)
+        crash = Event(from_states=(sleeping, running), to_state=broken)
+
+    eq_(Robot.events_from('sleeping'), ('crash', 'run'))
+    eq_(Robot.events_from(Robot.running), ('crash', 'sleep'))
+    eq_(Robot.events_from('broken'), ())
+    with assert_raises(ValueError):
+        Robot.events_from('flying')
+
+    robot = Robot()
+    robot.battery = 50
+    eq_(robot.available_events, ('crash', 'run'))
+    # guards are taken into account
+    robot.battery = 0
+    eq_(robot.available_events, ('crash',))
+
+
+def test_mask_in_state():
+    @acts_as_state_machine(state_codes={'sleeping': 0, 'running': 1, 'cleaning': 2})
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+
+    robots = [Robot(), Robot(), Robot()]
+    robots[1].run()
+    robots[2].run()
+    robots[2].cleanup()
+    eq_(Robot.mask_in_state(robots, 'running'), [False, True, False])
+    eq_(Robot.mask_in_state(robots, Robot.running, 'cleaning'), [False, True, True])
+    eq_(Robot.mask_in_state(robots, 'running'), [robot.is_running for robot in robots])
+
+
+def test_nested_states():
+    @acts_as_state_machine
+    class Order():
+        pending = State(initial=True)
+        shipping = State()
+        packed = State(parent=shipping)
+        in_transit = State(parent=shipping)
+        at_customs = State(parent=in_transit)
+        cancelled = State()
+
+        ship = Event(from_states=pending, to_state=packed)
+        send = Event(from_states=packed, to_state=at_customs)
+        cancel = Event(from_states=(pending, shipping), to_state=cancelled)
+
+    order = Order()
+    order.ship()
+    order.send()
+    assert order.is_at_customs
+    assert order.is_in_transit
+    assert order.is_shipping
+    assert not order.is_packed
+    # an event of a parent state can be fired from any of its substates
+    eq_(Order.events_from('at_customs'), ('cancel',))
+    eq_(Order.mask_in_state([order, Order()], 'shipping'), [True, False])
+    order.cancel()
+    assert order.is_cancelled
+    assert not order.is_shipping
+
+    with assert_raises(ValueError):
+        elsewhere = State()
+
+        @acts_as_state_machine
+        class Parcel():
+            pending = State(initial=True, parent=elsewhere)
+
+
+def test_regions():
+    @acts_as_state_machine
+    class Order():
+        open = State(initial=True)
+        closed = State()
+
+        unpaid = State(initial=True, region='payment')
+        paid = State(region='payment')
+
+        waiting = State(initial=True, region='fulfilment')
+        shipped = State(region='fulfilment')
+
+        close = Event(from_states=open, to_state=closed)
+        pay = Event(from_states=unpaid, to_state=paid)
+        ship = Event(from_states=waiting, to_state=shipped)
+
+        @after('ship')
+        def notify(self):
+            things_done.append('notify')
+
+    things_done = []
+    order = Order()
+    eq_((order.aasm_state, order.payment_state, order.fulfilment_state), ('open', 'unpaid', 'waiting'))
+    eq_(order.available_events, ('close', 'pay', 'ship'))
+
+    order.pay()
+    assert order.is_paid
+    assert order.is_open
+    with assert_raises(InvalidStateTransition):
+        order.pay()
+
+    from state_machine import instrumentation
+    other = Order()
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        other.fire_parallel('pay', 'ship', 'close')
+    finally:
+        instrumentation.disable()
+    eq_((other.current_state, other.payment_state, other.fulfilment_state), ('closed', 'paid', 'shipped'))
+    eq_(things_done, ['notify'])
+    # timed per event like the events of the main region
+    latencies = instrumentation.snapshot()['latencies']
+    name = instrumentation.class_label(Order)
+    eq_(sorted(key[1:] for key in latencies), [('close', 'guard'), ('close', 'update'), ('pay', 'guard'),
+                                              ('pay', 'update'), ('ship', 'after'), ('ship', 'guard'),
+                                              ('ship', 'update')])
+    eq_(set(key[0] for key in latencies), set([name]))
+    instrumentation.reset()
+    eq_(Order.mask_in_state([order, other], 'shipped'), [False, True])
+
+    # nothing moves unless every event can fire
+    with assert_raises(InvalidStateTransition):
+        order.fire_parallel('ship', 'pay')
+    assert order.is_waiting
+    with assert_raises(ValueError):
+        order.fire_parallel('pay', 'pay')
+
+    with assert_raises(ValueError):
+        @acts_as_state_machine
+        class Parcel():
+            open = State(initial=True)
+            unpaid = State(initial=True, region='payment')
+
+            pay = Event(from_states=open, to_state=unpaid)
+
+
+def test_reachability():
+    @acts_as_state_machine
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+        broken = State()
+        lost = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+        sleep = Event(from_states=(running, cleaning), to_state=sleeping)
+        crash = Event(from_states=cleaning, to_state=broken)
+
+    eq_(Robot.unreachable_states, frozenset(['lost']))
+    eq_(Robot.terminal_states, frozenset(['broken', 'lost']))
+    assert Robot.can_reach('sleeping', 'broken')
+    assert Robot.can_reach(Robot.running, Robot.running)
+    assert not Robot.can_reach('broken', 'sleeping')
+    eq_(Robot.shortest_path('sleeping', 'broken'), ('run', 'cleanup', 'crash'))
+    eq_(Robot.shortest_path('cleaning', 'running'), ('sleep', 'run'))
+    eq_(Robot.shortest_path('lost', 'sleeping'), None)
+    with assert_raises(ValueError):
+        Robot.can_reach('sleeping', 'flying')
+
+    with assert_raises(ValueError):
+        @acts_as_state_machine
+        class Vacuum():
+            sleeping = State(initial=True)
+
+            run = Event(from_states=sleeping, to_state=State())
+
+    # a parent state is reached, left and arrived at through its substates
+    @acts_as_state_machine
+    class Order():
+        pending = State(initial=True)
+        shipping = State()
+        packed = State(parent=shipping)
+        in_transit = State(parent=shipping)
+        delivered = State()
+
+        ship = Event(from_states=pending, to_state=packed)
+        send = Event(from_states=packed, to_state=in_transit)
+        deliver = Event(from_states=in_transit, to_state=delivered)
+
+    eq_(Order.unreachable_states, frozenset())
+    eq_(Order.terminal_states, frozenset(['delivered']))
+    assert Order.can_reach('pending', 'shipping')
+    assert Order.can_reach('shipping', 'delivered')
+    assert not Order.can_reach('delivered', 'shipping')
+    eq_(Order.shortest_path('pending', 'shipping'), ('ship',))
+    eq_(Order.shortest_path('shipping', 'delivered'), ('deliver',))
+    eq_(Order.shortest_path('packed', 'shipping'), ())
+
+
+def test_export():
+    import json
+    import shutil
+    import sys
+    import tempfile
+    from state_machine import export
+
+    @acts_as_state_machine
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+        broken = State(parent=running)
+
+        run = Event(from_states=sleeping, to_state=running)
+        crash = Event(from_states=running, to_state=broken)
+
+    eq_(export.to_dict(Robot), {
+        'name': 'Robot',
+        'states': ['broken', 'running', 'sleeping'],
+        'initial': ['sleeping'],
+        'transitions': [['broken', 'crash', 'broken'], ['running', 'crash', 'broken'],
+                        ['sleeping', 'run', 'running']],
+        'parents': {'broken': 'running'},
+    })
+    dot = export.to_dot(Robot)
+    assert '"sleeping" -> "running" [label="run"];' in dot
+    assert '"__initial_sleeping" -> "sleeping";' in dot
+
+    # a parent state that its substates leave is not drawn as terminal
+    @acts_as_state_machine
+    class Parcel():
+        pending = State(initial=True)
+        shipping = State()
+        packed = State(parent=shipping)
+        in_transit = State(parent=shipping)
+        delivered = State()
+
+        ship = Event(from_states=pending, to_state=packed)
+        send = Event(from_states=packed, to_state=in_transit)
+        deliver = Event(from_states=in_transit, to_state=delivered)
+
+    dot = export.to_dot(Parcel)
+    assert '"shipping" [shape=ellipse];' in dot
+    assert '"delivered" [shape=doublecircle];' in dot
+
+    # substates are exported in the region of their parent
+    @acts_as_state_machine
+    class Order():
+        open = State(initial=True)
+        unpaid = State(initial=True, region='payment')
+        paying = State(region='payment')
+        authorized = State(parent=paying)
+
+        pay = Event(from_states=unpaid, to_state=authorized)
+
+    eq_(export.to_dict(Order)['regions'], {'unpaid': 'payment', 'paying': 'payment', 'authorized': 'payment'})
+    dot = export.to_dot(Order)
+    assert dot.index('"authorized" [shape=') > dot.index('subgraph "cluster_payment"')
+
+    # the command line exports every machine of a module
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, 'exported_machines.py'), 'w') as module_file:
+        module_file.write("\n".join([
+            "from state_machine import acts_as_state_machine, State, Event",
+            "@acts_as_state_machine",
+            "class Door(object):",
+            "    closed = State(initial=True)",
+            "    opened = State()",
+            "    open = Event(from_states=closed, to_state=opened)",
+        ]))
+    output = os.path.join(directory, 'machines.json')
+    sys.path.insert(0, directory)
+    try:
+        eq_(export.main(['--format', 'json', '-o', output, 'exported_machines']), 0)
+        with open(output) as output_file:
+            eq_(json.load(output_file)['exported_machines:Door']['transitions'], [['closed', 'open', 'opened']])
+    finally:
+        sys.path.remove(directory)
+        shutil.rmtree(directory)
+
+
+def test_lazy_state_machine():
+    @acts_as_state_machine(lazy=True)
+    class Robot():
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+        @after('run')
+        def beep(self):
+            things_done.append('beep')
+
+    class Vacuum(Robot):
+        pass
+
+    # nothing is compiled until the class is used
+    assert 'transition_table' not in Robot.__dict__
+    things_done = []
+
+    vacuum = Vacuum()
+    assert vacuum.is_sleeping
+    vacuum.run()
+    eq_(vacuum.current_state, 'running')
+    eq_(things_done, ['beep'])
+    eq_(Robot.transition_table, {'sleeping': {'run': 'running'}})
+
+    @acts_as_state_machine(lazy=True)
+    class Charger():
+        idle = State(initial=True)
+        charging = State()
+
+        charge = Event(from_states=idle, to_state=charging)
+
+    # asking for a generated member compiles the class too
+    eq_(Charger.transition_table, {'idle': {'charge': 'charging'}})
+    with assert_raises(AttributeError):
+        Charger.is_broken
+
+
 ###################################################################################
 ## SqlAlchemy Tests
 ###################################################################################
@@ -305,6 +1167,341 @@ def test_sqlalchemy_state_machine_using_initial_state():
 
     assert penguin2.is_sleeping
 
+    # a row written without a state has no events, rather than failing
+    with engine.begin() as connection:
+        connection.execute(Penguin.__table__.insert().values(name='Stateless', aasm_state=None))
+    penguin3 = session.query(Penguin).filter_by(name='Stateless').one()
+    assert not penguin3.is_sleeping
+    eq_(penguin3.available_events, ())
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_bulk_transition():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+
+    @acts_as_state_machine
+    class Hamster(Base):
+        __tablename__ = 'hamsters'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String)
+
+        sleeping = State(initial=True)
+        running = State()
+        cleaning = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        cleanup = Event(from_states=running, to_state=cleaning)
+        sleep = Event(from_states=(running, cleaning), to_state=sleeping)
+
+        @after('cleanup')
+        def tidy(self):
+            tidied.append(self.name)
+
+    tidied = []
+    Base.metadata.create_all(engine)
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    hamsters = [Hamster(name=name) for name in ('a', 'b', 'c', 'd')]
+    hamsters[3].run()
+    session.add_all(hamsters)
+    session.commit()
+
+    eq_(Hamster.bulk_transition(session, 'run', Hamster.name != 'c'), 2)
+    session.commit()
+    eq_([hamster.current_state for hamster in hamsters], ['running', 'running', 'sleeping', 'running'])
+
+    eq_(Hamster.bulk_transition(session, 'cleanup', Hamster.name.in_(['a', 'c', 'd']), run_after_callbacks=True), 2)
+    session.commit()
+    eq_(sorted(tidied), ['a', 'd'])
+    eq_([hamster.current_state for hamster in hamsters], ['cleaning', 'running', 'sleeping', 'cleaning'])
+
+    # counted like any other transition
+    from state_machine import instrumentation
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        eq_(Hamster.bulk_transition(session, 'sleep', Hamster.name.in_(['a', 'd']), run_after_callbacks=True), 2)
+        session.commit()
+    finally:
+        instrumentation.disable()
+    name = instrumentation.class_label(Hamster)
+    snapshot = instrumentation.snapshot()
+    eq_(snapshot['transitions'], {(name, 'sleep'): 2})
+    eq_(snapshot['latencies'][(name, 'sleep', 'update')]['count'], 1)
+    instrumentation.reset()
+    Hamster.bulk_transition(session, 'run', Hamster.name.in_(['a', 'd']))
+    Hamster.bulk_transition(session, 'cleanup', Hamster.name.in_(['a', 'd']))
+    session.commit()
+
+    # the rows are read back in one SELECT, and without RETURNING they are locked first
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0])
+
+    del tidied[:]
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', count_statements)
+    dialect = engine.dialect
+    returning = dialect.update_returning
+    dialect.update_returning = False
+    try:
+        eq_(Hamster.bulk_transition(session, 'cleanup', Hamster.name != 'c',
+                                    run_after_callbacks=True, synchronize_session=False), 1)
+        session.commit()
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', count_statements)
+        dialect.update_returning = returning
+    eq_(tidied, ['b'])
+    eq_(statements.count('SELECT'), 2)
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_optimistic_locking():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+
+    @acts_as_state_machine(optimistic_locking=True)
+    class Parrot(Base):
+        __tablename__ = 'parrots'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String)
+
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+    Base.metadata.create_all(engine)
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    parrot = Parrot(name='Polly')
+    session.add(parrot)
+    session.commit()
+
+    # two workers holding their own copy of the same row
+    first_session, second_session = Session(), Session()
+    first = first_session.query(Parrot).filter_by(id=parrot.id).one()
+    second = second_session.query(Parrot).filter_by(id=parrot.id).one()
+
+    first.run()
+    first_session.commit()
+
+    with assert_raises(TransitionConflict):
+        second.run()
+    assert second.is_sleeping
+    second_session.rollback()
+
+    eq_(second_session.query(Parrot).filter_by(id=parrot.id).one().current_state, 'running')
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_state_codes():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+
+    @acts_as_state_machine(state_codes={'sleeping': 1, 'running': 2})
+    class Ferret(Base):
+        __tablename__ = 'ferrets'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        name = sqlalchemy.Column(sqlalchemy.String)
+
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+    assert isinstance(Ferret.__table__.c.aasm_state.type, sqlalchemy.SmallInteger)
+    Base.metadata.create_all(engine)
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    ferrets = [Ferret(name='a'), Ferret(name='b')]
+    ferrets[0].run()
+    session.add_all(ferrets)
+    session.commit()
+
+    eq_(session.query(Ferret).filter_by(aasm_state=2).one().name, 'a')
+    eq_(Ferret.bulk_transition(session, 'run'), 1)
+    session.commit()
+    eq_([ferret.current_state for ferret in ferrets], ['running', 'running'])
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_state_index_and_queries():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+
+    @acts_as_state_machine(state_codes={'sleeping': 1, 'running': 2, 'broken': 3},
+                           state_index=('tenant_id', 'aasm_state'))
+    class Gerbil(Base):
+        __tablename__ = 'gerbils'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        tenant_id = sqlalchemy.Column(sqlalchemy.Integer)
+
+        sleeping = State(initial=True)
+        running = State()
+        broken = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+    eq_([[column.name for column in index.columns] for index in Gerbil.__table__.indexes],
+        [['tenant_id', 'aasm_state']])
+    Base.metadata.create_all(engine)
+    eq_([index['name'] for index in sqlalchemy.inspect(engine).get_indexes('gerbils')],
+        ['ix_gerbils_tenant_id_aasm_state'])
+
+    session = sessionmaker(bind=engine)()
+    gerbils = [Gerbil(tenant_id=1), Gerbil(tenant_id=1), Gerbil(tenant_id=2)]
+    gerbils[0].run()
+    session.add_all(gerbils)
+    session.commit()
+
+    eq_(Gerbil.in_state(session, 'running').all(), gerbils[:1])
+    eq_(Gerbil.in_state(session, Gerbil.sleeping, 'running').filter_by(tenant_id=1).count(), 2)
+    eq_(Gerbil.count_by_state(session), {'sleeping': 2, 'running': 1, 'broken': 0})
+    eq_(Gerbil.count_by_state(session, Gerbil.tenant_id == 2), {'sleeping': 1, 'running': 0, 'broken': 0})
+
+    with assert_raises(ValueError):
+        @acts_as_state_machine(state_index=('tenant_id',))
+        class Hamster(Base):
+            __tablename__ = 'hamsters'
+            id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+            tenant_id = sqlalchemy.Column(sqlalchemy.Integer)
+
+            sleeping = State(initial=True)
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_regions():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+
+    @acts_as_state_machine(optimistic_locking=True)
+    class Shipment(Base):
+        __tablename__ = 'shipments'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        unpaid = State(initial=True, region='payment')
+        paid = State(region='payment')
+
+        waiting = State(initial=True, region='fulfilment')
+        shipped = State(region='fulfilment')
+
+        pay = Event(from_states=unpaid, to_state=paid)
+        ship = Event(from_states=waiting, to_state=shipped)
+
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    shipment = Shipment()
+    session.add(shipment)
+    session.commit()
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    stale_session = Session()
+    stale = stale_session.get(Shipment, shipment.id)
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', record)
+    try:
+        shipment.fire_parallel('pay', 'ship')
+        session.commit()
+    finally:
+        sqlalchemy.event.remove(engine, 'before_cursor_execute', record)
+    # both regions were written by the one conditional UPDATE
+    eq_(len([statement for statement in statements if statement.startswith('UPDATE')]), 1)
+
+    session.expire_all()
+    eq_((shipment.payment_state, shipment.fulfilment_state), ('paid', 'shipped'))
+    eq_(Shipment.in_state(session, 'shipped').all(), [shipment])
+    with assert_raises(TransitionConflict):
+        stale.pay()
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_journal_sink():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+    from state_machine.journal import TransitionJournal, SqlAlchemySink, journal_table
+
+    Base = declarative_base()
+    transitions = journal_table(Base.metadata, 'hedgehog_transitions')
+
+    @acts_as_state_machine(journal=TransitionJournal(capacity=16, sink=SqlAlchemySink(engine, transitions)))
+    class Hedgehog(Base):
+        __tablename__ = 'hedgehogs'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    hedgehog = Hedgehog()
+    session.add(hedgehog)
+    session.commit()
+
+    hedgehog.run()
+    session.commit()
+    Hedgehog.journal.flush()
+
+    with engine.connect() as connection:
+        rows = connection.execute(sqlalchemy.select(transitions.c.document_id, transitions.c.event,
+                                                    transitions.c.from_state, transitions.c.to_state)).all()
+    eq_([tuple(row) for row in rows], [(str(hedgehog.id), 'run', 'sleeping', 'running')])
+
+
+@requires_sqlalchemy
+def test_sqlalchemy_keeps_columns_named_like_options():
+    from sqlalchemy.ext.declarative import declarative_base
+    from sqlalchemy.orm import sessionmaker
+
+    Base = declarative_base()
+
+    # journal and after_executor are only class members when the options are given
+    @acts_as_state_machine
+    class Weasel(Base):
+        __tablename__ = 'weasels'
+        id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+        journal = sqlalchemy.Column(sqlalchemy.String)
+        after_executor = sqlalchemy.Column(sqlalchemy.String)
+
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    weasel = Weasel(journal='dear diary', after_executor='the night shift')
+    weasel.run()
+    session.add(weasel)
+    session.commit()
+    session.expire_all()
+
+    weasel = session.query(Weasel).filter(Weasel.journal == 'dear diary',
+                                          Weasel.after_executor == 'the night shift').one()
+    eq_(weasel.current_state, 'running')
+
 
 ###################################################################################
 ## Mongo Engine Tests
@@ -412,5 +1609,104 @@ def test_before_callback_blocking_transition():
     assert not runner.is_running
 
 
+@requires_mongoengine
+@with_setup(clear_mongo_databases, clear_mongo_databases)
+def test_mongoengine_atomic_updates():
+    establish_mongo_connection()
+
+    @acts_as_state_machine(atomic_updates=True)
+    class Worker(mongoengine.Document):
+        name = mongoengine.StringField(default='Billy')
+
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+        sleep = Event(from_states=running, to_state=sleeping)
+
+    worker = Worker()
+    worker.save()
+
+    # two copies of the same document race to fire the same event
+    first = Worker.objects(id=worker.id).first()
+    second = Worker.objects(id=worker.id).first()
+    first.run()
+    assert first.is_running
+    with assert_raises(InvalidStateTransition):
+        second.run()
+    assert second.is_sleeping
+
+    # the state was written by the transition itself, so a later save cannot clobber it
+    first.name = 'Bob'
+    first.save()
+    eq_(Worker.objects(id=worker.id).first().current_state, 'running')
+
+    others = [Worker.objects(id=worker.id).first() for _ in range(2)]
+    result = Worker.fire_many('sleep', others)
+    eq_(result.accepted, others[:1])
+    eq_(result.rejected, others[1:])
+
+    with assert_raises(TypeError):
+        @acts_as_state_machine(atomic_updates=True)
+        class Robot(object):
+            sleeping = State(initial=True)
+
+
+@requires_mongoengine
+@with_setup(clear_mongo_databases, clear_mongo_databases)
+def test_mongoengine_state_index_and_queries():
+    establish_mongo_connection()
+
+    @acts_as_state_machine(state_index=('tenant_id', 'aasm_state'))
+    class Cleaner(mongoengine.Document):
+        tenant_id = mongoengine.IntField()
+
+        sleeping = State(initial=True)
+        running = State()
+
+        run = Event(from_states=sleeping, to_state=running)
+
+    cleaners = [Cleaner(tenant_id=1), Cleaner(tenant_id=1), Cleaner(tenant_id=2)]
+    cleaners[0].run()
+    for cleaner in cleaners:
+        cleaner.save()
+
+    index_keys = [index['key'] for index in Cleaner._get_collection().index_information().values()]
+    assert [('tenant_id', 1), ('aasm_state', 1)] in index_keys
+
+    eq_(list(Cleaner.in_state('running')), cleaners[:1])
+    eq_(Cleaner.in_state(Cleaner.sleeping, 'running', tenant_id=1).count(), 2)
+    eq_(Cleaner.count_by_state(), {'sleeping': 2, 'running': 1})
+    eq_(Cleaner.count_by_state(tenant_id=2), {'sleeping': 1, 'running': 0})
+
+
+@requires_mongoengine
+@with_setup(clear_mongo_databases, clear_mongo_databases)
+def test_mongoengine_regions():
+    establish_mongo_connection()
+
+    @acts_as_state_machine(atomic_updates=True)
+    class Delivery(mongoengine.Document):
+        unpaid = State(initial=True, region='payment')
+        paid = State(region='payment')
+
+        waiting = State(initial=True, region='fulfilment')
+        shipped = State(region='fulfilment')
+
+        pay = Event(from_states=unpaid, to_state=paid)
+        ship = Event(from_states=waiting, to_state=shipped)
+
+    delivery = Delivery()
+    delivery.save()
+    stale = Delivery.objects(id=delivery.id).first()
+    delivery.fire_parallel('pay', 'ship')
+
+    stored = Delivery.objects(id=delivery.id).first()
+    eq_((stored.payment_state, stored.fulfilment_state), ('paid', 'shipped'))
+    eq_(list(Delivery.in_state('paid')), [delivery])
+    with assert_raises(InvalidStateTransition):
+        stale.pay()
+
+
 if __name__ == "__main__":
     nose.run()